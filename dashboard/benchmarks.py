@@ -0,0 +1,305 @@
+"""
+Micro-benchmarks for the hot paths of the dashboard.
+
+Run from the dashboard directory, e.g.:
+    python benchmarks.py product_decoder --rows 2000000
+"""
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import plotly.graph_objects as go
+
+from dateutil.parser import parse
+
+from functions import (add_calendar_columns, bar3d_traces, decode_product_column, format_dates, format_numbers,
+                       infer_date_format, parse_dates, truncate_labels, clean_product_name,
+                       extract_product_type_and_specs, normalize_product_column, clean_numeric_columns,
+                       header_finder, read_raw_export, iter_excel_rows, python_calamine)
+
+
+def make_sales_frame(rows, n_products=3000, seed=0):
+    # Synthetic export shaped like the real one: a few thousand distinct products
+    # repeated over millions of rows
+    rng = np.random.default_rng(seed)
+    kinds = ['труба проф', 'лист', 'уголок', 'круг', 'полоса', 'арматура', 'швеллер']
+    catalog = [repr((kinds[i % len(kinds)], f"{10 + i % 90}*{i % 7 + 1}*{i % 5 + 1}.5")) for i in range(n_products)]
+    picks = rng.integers(0, n_products, rows)
+    index = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 4 * 365 * 86400, rows), unit='s')
+    return pd.DataFrame({
+        'product': np.asarray(catalog, dtype=object)[picks],
+        'Сумма': rng.gamma(2.0, 150000.0, rows).round(2),
+        'Количество': rng.gamma(1.5, 400.0, rows).round(1),
+        'Склад': rng.choice(['Склад 1', 'Склад 2', 'Склад 3'], rows),
+    }, index=pd.DatetimeIndex(index, name='Дата'))
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_product_decoder(rows):
+    df = make_sales_frame(rows)
+
+    def legacy(products):
+        products = products.apply(eval)
+        return products.apply(lambda x: x[0]), products.apply(lambda x: x[1])
+
+    _, legacy_time = timed(legacy, df['product'])
+    _, decoder_time = timed(decode_product_column, df['product'])
+    print(f"eval + lambdas:        {rows / legacy_time:>14,.0f} rows/s ({legacy_time:.2f} s)")
+    print(f"decode_product_column: {rows / decoder_time:>14,.0f} rows/s ({decoder_time:.2f} s)")
+    print(f"speedup: {legacy_time / decoder_time:.1f}x")
+
+
+def bench_period_groupby(rows):
+    df = make_sales_frame(rows)
+
+    def legacy_calendar(df):
+        year = df.index.year.astype(str)
+        return pd.DataFrame({
+            'Год': year,
+            'ГодМесяц': df.index.strftime('%Y-%m'),
+            'ГодЧетверть': year + '-Q' + df.index.quarter.astype(str),
+            'Сумма': df['Сумма'],
+        }, index=df.index)
+
+    legacy, legacy_build = timed(legacy_calendar, df)
+    compact, compact_build = timed(add_calendar_columns, df[['Сумма']].copy())
+    print(f"build calendar columns: strings {legacy_build:.2f} s, integers {compact_build:.2f} s")
+    for col in ['Год', 'ГодМесяц', 'ГодЧетверть']:
+        _, legacy_time = timed(lambda: legacy.groupby(col)['Сумма'].sum())
+        _, compact_time = timed(lambda: compact.groupby(col)['Сумма'].sum())
+        print(f"groupby {col:<12} strings {legacy_time:.3f} s, integers {compact_time:.3f} s "
+              f"({legacy_time / compact_time:.1f}x)")
+    legacy_mb = legacy.drop(columns='Сумма').memory_usage(deep=True).sum() / 1024 ** 2
+    compact_mb = compact.drop(columns='Сумма').memory_usage(deep=True).sum() / 1024 ** 2
+    print(f"memory of the period columns: strings {legacy_mb:,.0f} MB, integers {compact_mb:,.0f} MB")
+
+
+def legacy_3d_bars(values, labels, hover_text, colors):
+    # Previous renderer of the rating page: seven Scatter3d traces per bar
+    fig = go.Figure()
+    grid_size = int(np.ceil(np.sqrt(len(values))))
+    for index, value in enumerate(values):
+        x_pos = index % grid_size
+        y_pos = index // grid_size
+        for z in (value, 0):
+            fig.add_trace(go.Scatter3d(
+                x=[x_pos, x_pos + 0.7, x_pos + 0.7, x_pos, x_pos],
+                y=[y_pos, y_pos, y_pos + 0.7, y_pos + 0.7, y_pos],
+                z=[z] * 5, mode='lines', line=dict(color=colors[index], width=6), surfaceaxis=2,
+                text=hover_text[index], hoverinfo='text', showlegend=False))
+        for corner_x, corner_y in [(x_pos, y_pos), (x_pos + 0.7, y_pos), (x_pos + 0.7, y_pos + 0.7), (x_pos, y_pos + 0.7)]:
+            fig.add_trace(go.Scatter3d(x=[corner_x, corner_x], y=[corner_y, corner_y], z=[0, value], mode='lines',
+                                       line=dict(color=colors[index], width=6), showlegend=False))
+        fig.add_trace(go.Scatter3d(x=[x_pos + 0.35], y=[y_pos + 0.35], z=[value * 1.05], mode='text',
+                                   text=[labels[index]], textposition='top center', showlegend=False))
+    return fig
+
+
+def bench_3d_bars(rows):
+    # rows is not used: the chart size is the number of bars
+    rng = np.random.default_rng(0)
+    for items in (15, 100, 500):
+        values = rng.gamma(2.0, 1e6, items)
+        labels = [f"товар {i}" for i in range(items)]
+        hover_text = [f"{label}<br>{value:,.0f} ₸" for label, value in zip(labels, values)]
+        colors = ['rgb(31,120,180)'] * items
+
+        legacy, legacy_time = timed(legacy_3d_bars, values, labels, hover_text, colors)
+        legacy_json, legacy_json_time = timed(legacy.to_json)
+
+        def batched():
+            fig = go.Figure()
+            fig.add_traces(bar3d_traces(values, labels, hover_text, colors)[0])
+            return fig
+
+        batch, batch_time = timed(batched)
+        batch_json, batch_json_time = timed(batch.to_json)
+        print(f"{items:>4} bars: legacy {len(legacy.data):>5} traces, {len(legacy_json) / 1024:>8,.0f} KB, "
+              f"{legacy_time + legacy_json_time:.3f} s | batched {len(batch.data)} traces, "
+              f"{len(batch_json) / 1024:>6,.0f} KB, {batch_time + batch_json_time:.3f} s")
+
+
+def bench_formatting(rows):
+    df = make_sales_frame(rows)
+    df['Цена'] = (df['Сумма'] / df['Количество']).round(2)
+
+    def legacy_hover(df):
+        return df.apply(
+            lambda row: f"Дата: {row.name.strftime('%d.%m.%Y')}<br>" +
+                        f"Цена: {row['Цена']:.2f} ₸<br>" +
+                        f"Сумма: {row['Сумма']:,.0f} ₸<br>" +
+                        f"Количество: {row['Количество']:,.1f} кг",
+            axis=1
+        )
+
+    def vectorized_hover(df):
+        return ("Дата: " + format_dates(df.index) +
+                "<br>Цена: " + format_numbers(df['Цена'], 2, '₸', separator='') +
+                "<br>Сумма: " + format_numbers(df['Сумма'], 0, '₸') +
+                "<br>Количество: " + format_numbers(df['Количество'], 1, 'кг'))
+
+    legacy, legacy_time = timed(legacy_hover, df)
+    vectorized, vectorized_time = timed(vectorized_hover, df)
+    mismatches = (legacy.to_numpy() != vectorized.to_numpy()).sum()
+    print(f"hover text: apply(axis=1) {legacy_time:.2f} s, vectorized {vectorized_time:.2f} s "
+          f"({legacy_time / vectorized_time:.0f}x, {mismatches:,} rows differ in rounding)")
+
+    labels = df['product']
+    _, legacy_time = timed(lambda: [label[:10] + '...' if len(label) > 10 else label for label in labels])
+    _, vectorized_time = timed(truncate_labels, labels)
+    print(f"truncated labels: list comprehension {legacy_time:.2f} s, vectorized {vectorized_time:.2f} s "
+          f"({legacy_time / vectorized_time:.1f}x)")
+
+
+def bench_date_parsing(rows):
+    # Raw 1C exports carry the date as text, one timestamp per deal
+    dates = pd.Series(make_sales_frame(rows).index.strftime('%d.%m.%Y %H:%M:%S'))
+
+    def legacy(dates):
+        return dates.apply(lambda x: pd.to_datetime(parse(str(x), fuzzy=True), errors='coerce') if pd.notna(x) else pd.NaT)
+
+    sample = dates.head(min(rows, 20_000))
+    _, legacy_time = timed(legacy, sample)
+    legacy_rate = len(sample) / legacy_time
+    parsed, fast_time = timed(lambda: parse_dates(dates, infer_date_format(dates)))
+    print(f"dateutil fuzzy per value: {legacy_rate:>12,.0f} rows/s (measured on {len(sample):,} rows)")
+    print(f"inferred format:          {rows / fast_time:>12,.0f} rows/s ({fast_time:.2f} s, "
+          f"{parsed.isna().sum()} unparsed)")
+    print(f"speedup: {rows / fast_time / legacy_rate:.0f}x")
+
+
+def bench_product_normalization(rows):
+    # Raw names as they come from 1C, a few thousand distinct ones repeated over the rows
+    rng = np.random.default_rng(0)
+    kinds = ['Труба проф.', 'Лист г/к', 'Уголок', 'Круг ст.3', 'Полоса', 'Арматура А500С', 'Швеллер']
+    catalog = [f"{kinds[i % len(kinds)]} {10 + i % 90}х{i % 7 + 1}х{i % 5 + 1},5 L=6м." for i in range(3000)]
+    for n in (rows // 10, rows):
+        names = pd.Series(np.asarray(catalog, dtype=object)[rng.integers(0, len(catalog), n)])
+        legacy_time = None
+        if n <= 1_000_000:
+            _, legacy_time = timed(lambda: names.apply(clean_product_name).apply(extract_product_type_and_specs))
+        _, fast_time = timed(normalize_product_column, names)
+        legacy = f"{legacy_time:.2f} s" if legacy_time is not None else "skipped"
+        print(f"{n:>10,} rows, {len(catalog):,} unique names: per row {legacy}, per unique name {fast_time:.2f} s")
+
+
+def legacy_clean_numeric_columns(df):
+    # Previous implementation: float() probes, then every numeric-looking column
+    # (already numeric ones included) goes through strings
+    def is_numeric_like(col):
+        sample = col.dropna().head(10)
+        if len(sample) == 0:
+            return False
+        try:
+            [float(val.replace(' ', '').replace(',', '.') if isinstance(val, str) else val) for val in sample]
+            return True
+        except (ValueError, TypeError):
+            return False
+
+    for col in [col for col in df.columns if is_numeric_like(df[col])]:
+        df[col] = df[col].astype(str).str.replace(' ', '', regex=False).str.replace(',', '.', regex=False).astype(float)
+        df[col] = df[col].round(2)
+    return df
+
+
+def bench_numeric_cleaning(rows):
+    # A wide raw export: amounts as text with decimal commas and space separators next to
+    # columns that are already numeric
+    rng = np.random.default_rng(0)
+    columns = {}
+    for i in range(8):
+        amounts = rng.gamma(2.0, 15000.0, rows).round(2)
+        columns[f'text_{i}'] = pd.Series(amounts).map('{:,.2f}'.format).str.replace(',', ' ').str.replace('.', ',')
+        columns[f'number_{i}'] = amounts
+    df = pd.DataFrame(columns)
+
+    _, legacy_time = timed(legacy_clean_numeric_columns, df.copy())
+    cleaned, fast_time = timed(clean_numeric_columns, df.copy())
+    print(f"{rows:,} rows x {df.shape[1]} columns: legacy {legacy_time:.2f} s, vectorized {fast_time:.2f} s "
+          f"({legacy_time / fast_time:.1f}x), failures {cleaned.attrs['numeric_failures']}")
+
+
+def write_raw_workbook(path, rows, seed=0):
+    # Branch export as 1C saves it: report title rows above the header, then typed cells
+    rng = np.random.default_rng(seed)
+    names = ['Труба проф. 40х20х1,5 L=6', 'Лист г/к 3х1250х2500', 'Уголок 50x50x5', 'Круг 12 ст3', 'Швеллер 10П']
+    dates = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 700 * 86400, rows), unit='s')
+    quantity = rng.gamma(1.5, 400.0, rows).round(1)
+    price = rng.uniform(100, 900, rows).round(2)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['Отчет по продажам'])
+    sheet.append(['Период: 2023-2024'])
+    sheet.append([])
+    sheet.append(['Дата', 'Номенклатура', 'Склад', 'Количество', 'Цена', 'Сумма', 'Цена по прайсу'])
+    for date, name, warehouse, q, p in zip(dates.to_pydatetime(), rng.choice(names, rows),
+                                          rng.choice(['Основной', 'Дальний'], rows), quantity, price):
+        sheet.append([date, str(name), str(warehouse), float(q), float(p), round(q * p, 2), round(p * 1.1, 2)])
+    sheet.append(['Итого'])
+    workbook.save(path)
+
+
+def peak_memory(func, *args):
+    # Seconds and growth of the peak RSS in MB of func(*args), run in a forked process
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+
+    def child():
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        _, seconds = timed(func, *args)
+        results.put((seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024))
+
+    process = context.Process(target=child)
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def bench_excel_reading(rows):
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / 'export.xlsx'
+        _, write_time = timed(write_raw_workbook, path, rows)
+        print(f"{rows:,} rows workbook written in {write_time:.1f} s")
+        legacy_time, legacy_mb = peak_memory(lambda: header_finder(pd.read_excel(path, header=None)))
+        print(f"pd.read_excel + header_finder {legacy_time:.2f} s, peak +{legacy_mb:.0f} MB")
+        engines = ['openpyxl'] + (['calamine'] if python_calamine is not None else [])
+        for engine in engines:
+            fast_time, fast_mb = peak_memory(read_raw_export, path, 'cp1251', ';', None, engine)
+            print(f"read_raw_export ({engine}) {fast_time:.2f} s, peak +{fast_mb:.0f} MB "
+                  f"({legacy_time / fast_time:.1f}x)")
+        # The header scan alone: calamine has already loaded the sheet at the first row
+        for engine in engines:
+            scan_time, scan_mb = peak_memory(lambda: next(iter_excel_rows(path, engine)))
+            print(f"first row ({engine}) {scan_time:.2f} s, peak +{scan_mb:.0f} MB")
+        print("dtypes:", dict(read_raw_export(path).dtypes.astype(str)))
+
+
+BENCHMARKS = {
+    'product_decoder': bench_product_decoder,
+    'period_groupby': bench_period_groupby,
+    '3d_bars': bench_3d_bars,
+    'formatting': bench_formatting,
+    'date_parsing': bench_date_parsing,
+    'product_normalization': bench_product_normalization,
+    'numeric_cleaning': bench_numeric_cleaning,
+    'excel_reading': bench_excel_reading,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=list(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.rows)
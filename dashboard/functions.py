@@ -1,61 +1,96 @@
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import lzma
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import openpyxl
 import pandas as pd
+import plotly.graph_objects as go
 from dateutil.parser import parse
-from fuzzywuzzy import fuzz
+import Levenshtein
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+from pyarrow import feather
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import re
 import streamlit as st
+import zstandard
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
-def header_finder(df):
+try:
+    # Optional Rust reader for workbooks, several times faster than openpyxl
+    import python_calamine
+except ImportError:
+    python_calamine = None
 
-    for index, row in df.iterrows():
-        # Count the number of non nan values in a row
-        non_nan_count = df.iloc[index, 1:].notna().sum()  # Check columns 1 to end
-        if non_nan_count >= 6:  # Adjust threshold as needed
-            header_row = index
+# The header of a raw export sits in its first rows, below a few rows of report title
+HEADER_SEARCH_ROWS = 50
+
+
+def header_finder(df, search_rows=HEADER_SEARCH_ROWS, min_filled=6):
+    """
+    Turn a raw Excel dump into a frame with proper column names.
+
+    The header is the first of the top `search_rows` rows with at least `min_filled`
+    non-empty cells after the first column. A neighbouring row mentioning "Ссылка" is
+    merged into it as a second header line. Only the top rows are inspected, so the
+    cost does not depend on the number of data rows. Raises ValueError when no row
+    qualifies as a header.
+    """
+    columns, data_start = find_header(df, search_rows, min_filled)
+    df = df.iloc[data_start:].reset_index(drop=True)
+    df.columns = columns
+    return df
+
+
+def find_header(df, search_rows=HEADER_SEARCH_ROWS, min_filled=6):
+    # Column names and position of the first data row of a raw dump, see header_finder
+    # Step 1: one vectorized count of filled cells over the top rows
+    filled = df.iloc[:search_rows, 1:].notna().sum(axis=1).to_numpy()
+    candidates = np.flatnonzero(filled >= min_filled)
+    if not len(candidates):
+        raise ValueError(f"No header row found: none of the first {min(search_rows, len(df))} rows "
+                         f"has at least {min_filled} filled cells")
+    header_row = int(candidates[0])
+
+    # Step 2: check the rows right above and below for "Ссылка"
+    neighbours = [i for i in (header_row - 1, header_row + 1) if 0 <= i < len(df)]
+    cells = df.iloc[neighbours].stack()
+    matches = cells.astype(str).str.contains('ссылка', case=False, regex=False)
+    matched_rows = cells.index[matches.to_numpy()].get_level_values(0)
+    additional_header_row = None
+    for i in neighbours:  # Take the first match, row above first
+        if df.index[i] in matched_rows:
+            additional_header_row = i
             break
 
+    # Step 3: merge header rows: use the header value if not NaN, otherwise the additional row's
+    new_header = df.iloc[header_row]
+    last_header_row = header_row
+    if additional_header_row is not None:
+        new_header = new_header.where(new_header.notna(), df.iloc[additional_header_row])
+        last_header_row = max(header_row, additional_header_row)
+
+    # Step 4: data starts after the header rows
+    columns = [
+        col.replace('Ссылка', '').replace('ссылка', '').replace('.', '').replace(',', '').strip() if isinstance(col,
+                                                                                                                str) else col
+        for col in new_header]
+    return columns, last_header_row + 1
+
 
-    if header_row is not None:
-        # Step 2: Define the range to check (three rows above and below)
-        start_row = max(0, header_row - 1)  # Avoid going below index 0
-        end_row =  header_row + 1
-
-        # Step 3: Check surrounding rows for "Ссылка"
-        additional_header_row = None
-        for i in range(start_row, end_row + 1):
-            if i != header_row:  # Skip the header_row itself
-                # Convert the row to strings and check for "Ссылка"
-                row_values = df.iloc[i].astype(str)
-                if any("Ссылка".lower() in str(val).lower() or "ссылка".lower() in str(val).lower() for val in row_values):
-                    additional_header_row = i
-                    break  # Take the first match, or adjust to collect all if needed
-
-        # Step 4: Merge header rows if additional_header_row is found
-        if additional_header_row is not None:
-            # Get the two rows to merge
-            row1 = df.iloc[header_row].copy()
-            row2 = df.iloc[additional_header_row].copy()
-
-            # Merge the rows: use row1 value if not NaN, otherwise use row2 value
-            merged_header = row1.where(row1.notna(), row2)
-
-            # Update the DataFrame with the merged header row
-            df.iloc[header_row] = merged_header
-            # Drop the additional header row since it's merged
-            df = df.drop(additional_header_row).reset_index(drop=True)
-
-        # Step 5: Set the headers
-        new_header = df.iloc[header_row]  # Row with potential (merged) headers
-        df = df[header_row + 1:]  # Data starts after header
-        df.columns = new_header  # Set as column names
-        df = df.reset_index(drop=True)  # Reset index after slicing
-        # After setting the headers (e.g., df.columns = new_header), add this:
-        # After setting the headers (e.g., df.columns = new_header), add this:
-        df.columns = [
-            col.replace('Ссылка', '').replace('ссылка', '').replace('.', '').replace(',', '').strip() if isinstance(col,
-                                                                                                                    str) else col
-            for col in df.columns]
 
-        return df
 
 
 
@@ -63,7 +98,104 @@ def header_finder(df):
 
 
 
+# Explicit date formats tried in rank order, day-first like the 1C exports
+DATE_FORMATS = [
+    '%d.%m.%Y %H:%M:%S',
+    '%d.%m.%Y %H:%M',
+    '%d.%m.%Y',
+    '%d.%m.%y %H:%M:%S',
+    '%d.%m.%y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y',
+]
+# Share of sampled values a format (or the fuzzy parser) must read to call a column dates
+DATE_MATCH_SHARE = 0.8
+# Inferred format per source schema (column names + date column), None when no explicit format fits
+_date_formats = {}
+
+
+def infer_date_format(values, sample_size=200):
+    """
+    First format of DATE_FORMATS that reads at least DATE_MATCH_SHARE of a sample of
+    `values`, each format tried with one vectorized pd.to_datetime call, or None.
+    """
+    sample = pd.Series(values).dropna().astype(str).str.strip().head(sample_size)
+    if sample.empty:
+        return None
+    for fmt in DATE_FORMATS:
+        parsed = pd.to_datetime(sample, format=fmt, errors='coerce')
+        if parsed.notna().mean() >= DATE_MATCH_SHARE:
+            return fmt
+    return None
+
+
+def _parse_with_format(text, fmt):
+    """
+    Strict vectorized parse of `text` (strings or NA) with `fmt`. The date and the time
+    half are each parsed once per distinct value, since an export holds a few thousand
+    days and at most 86400 times of day however many rows it has. Values that are not
+    laid out like the zero-padded format go through pd.to_datetime as a whole.
+    """
+    sample = pd.Timestamp(2000, 1, 1)
+    separator = next((char for char in (' ', 'T') if char in fmt), None)
+    date_fmt, _, time_fmt = fmt.partition(separator) if separator else (fmt, '', '')
+    date_width = len(sample.strftime(date_fmt))
+
+    laid_out = text.str.len() == len(sample.strftime(fmt))
+    if separator:
+        laid_out &= text.str.slice(date_width, date_width + 1) == separator
+    laid_out = laid_out.fillna(False).to_numpy(dtype=bool)
+    fixed = text[laid_out]
+
+    result = np.full(len(text), np.datetime64('NaT'), dtype='datetime64[ns]')
+    codes, uniques = pd.factorize(fixed.str.slice(0, date_width))
+    days = pd.to_datetime(pd.Series(uniques, dtype=object), format=date_fmt, errors='coerce')
+    values = days.to_numpy(dtype='datetime64[ns]')[codes]
+    if separator:
+        codes, uniques = pd.factorize(fixed.str.slice(date_width + 1))
+        times = pd.to_datetime(pd.Series(uniques, dtype=object), format=time_fmt, errors='coerce') - pd.Timestamp(1900, 1, 1)
+        values = values + times.to_numpy(dtype='timedelta64[ns]')[codes]
+    result[laid_out] = values
+
+    other = ~laid_out & text.notna().to_numpy()
+    if other.any():
+        result[other] = pd.to_datetime(text[other], format=fmt, errors='coerce').to_numpy(dtype='datetime64[ns]')
+    return pd.Series(result, index=text.index)
+
+
+def _fuzzy_date(value):
+    try:
+        return parse(value, fuzzy=True)
+    except (ValueError, TypeError, OverflowError):
+        return pd.NaT
+
+
+def parse_dates(values, fmt=None):
+    """
+    Parse a column of dates: vectorized with `fmt` when given, then dateutil's fuzzy
+    parser only for the values the format could not read, once per distinct value.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    text = values.where(values.isna(), values.astype(str).str.strip())
+    if fmt is not None:
+        parsed = _parse_with_format(text, fmt)
+    else:
+        parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
 
+    residual = parsed.isna() & text.notna()
+    if residual.any():
+        codes, uniques = pd.factorize(text[residual])
+        fallback = pd.to_datetime(pd.Series([_fuzzy_date(value) for value in uniques], dtype=object),
+                                  errors='coerce')
+        parsed[residual] = fallback.to_numpy()[codes]
+        print(f"Parsed {parsed[residual].notna().sum()} of {residual.sum()} dates "
+              f"({fallback.notna().sum()} of {len(uniques)} distinct) with the fuzzy parser")
+    return parsed
 
 
 def find_date_column(df):
@@ -72,27 +204,24 @@ def find_date_column(df):
     # Step 1: Search for date patterns in all columns (no dtype check)
     for column in df.columns:
         # Get the first 10 non-NaN values (or all if fewer exist)
-        sample_values = df[column].dropna().head(10).values.tolist()
+        sample_values = df[column].dropna().head(10)
 
-        if not sample_values:  # Skip if no non-NaN values
+        if sample_values.empty:  # Skip if no non-NaN values
             continue
 
-        date_count = 0
-        total_values = len(sample_values)
-
-        for value in sample_values:
-            try:
-                # Try to parse the value as a date
-                parse(str(value), fuzzy=True)
-                date_count += 1
-            except (ValueError, TypeError):
-                continue
+        # An explicit format is checked for the whole sample at once; the fuzzy
+        # parser is only tried when none fits
+        fmt = infer_date_format(sample_values)
+        if fmt is not None:
+            date_share = 1.0
+        else:
+            date_share = parse_dates(sample_values).notna().mean()
 
-        # If more than 50% of the sample values look like dates, consider it a date column
-        if date_count / total_values >= 0.8:
+        # If at least 80% of the sample values look like dates, consider it a date column
+        if date_share >= DATE_MATCH_SHARE:
             date_column = column
-            print(
-                f"Found potential date column: {column} (based on {date_count}/{total_values} values parsing as dates)")
+            print(f"Found potential date column: {column} ({date_share:.0%} of {len(sample_values)} values "
+                  f"parse as dates, format {fmt or 'fuzzy'})")
             return column
 
     if date_column is None:
@@ -112,10 +241,13 @@ def dates_fixer(df,date_column):
         raise KeyError(f"Column '{date_column}' not found in DataFrame")
     else:
         print(f"Selected date column: {date_column}")
-        # Convert the date column to datetime using dateutil.parser for flexibility
-        df[date_column] = df[date_column].apply(
-        lambda x: pd.to_datetime(parse(str(x), fuzzy=True), errors='coerce') if pd.notna(x) else pd.NaT)
-        print(f"Converted {date_column} to datetime format. Sample: {df[date_column].head()}")
+        # Files of the same schema share their date format, it is inferred once per schema
+        schema = (tuple(map(str, df.columns)), str(date_column))
+        if schema not in _date_formats:
+            _date_formats[schema] = infer_date_format(df[date_column])
+        fmt = _date_formats[schema]
+        df[date_column] = parse_dates(df[date_column], fmt)
+        print(f"Converted {date_column} to datetime format ({fmt or 'fuzzy'}). Sample: {df[date_column].head()}")
         df.set_index(date_column, inplace=True)
         df.index = df.index.floor('s')
         print(f"Number of nan in index is {df.index.isna().sum()}")
@@ -167,25 +299,32 @@ def detect_product_column(df):
     return None, None  # No product column detected
 
 
-def clean_product_name(product_name):
-    if not product_name or pd.isna(product_name):
-        return ""
-    # Convert to string, lowercase, and trim extra whitespace
-    product_name = str(product_name).lower().strip()
+# Product name normalization steps, in order, as (compiled pattern, replacement)
+PRODUCT_NAME_RULES = [
     # Replace multiple spaces with a single space
-    product_name = re.sub(r'\s+', ' ', product_name)
+    (re.compile(r'\s+'), ' '),
     # Normalize decimal separators first (e.g., "1,5" to "1.5")
-    product_name = re.sub(r'(\d+),(\d+)', r'\1.\2', product_name)
+    (re.compile(r'(\d+),(\d+)'), r'\1.\2'),
     # Remove commas and semicolons
-    product_name = re.sub(r'[,;]', '', product_name)
+    (re.compile(r'[,;]'), ''),
     # Remove periods that are not part of a number
-    product_name = re.sub(r'(?<!\d)\.(?!\d)', '', product_name)
+    (re.compile(r'(?<!\d)\.(?!\d)'), ''),
     # Replace abbreviation periods (a period following a letter and preceding a digit) with a space
-    product_name = re.sub(r'(?<=[^\d\s])\.(?=\d)', ' ', product_name)
+    (re.compile(r'(?<=[^\d\s])\.(?=\d)'), ' '),
     # Replace 'x' (or Cyrillic 'х') with '*' only when it's between digits
-    product_name = re.sub(r'(?<=\d)\s*[xх]\s*(?=\d)', '*', product_name)
+    (re.compile(r'(?<=\d)\s*[xх]\s*(?=\d)'), '*'),
     # Collapse any extra spaces that may have been introduced
-    product_name = re.sub(r'\s+', ' ', product_name)
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def clean_product_name(product_name):
+    if not product_name or pd.isna(product_name):
+        return ""
+    # Convert to string, lowercase, and trim extra whitespace
+    product_name = str(product_name).lower().strip()
+    for pattern, replacement in PRODUCT_NAME_RULES:
+        product_name = pattern.sub(replacement, product_name)
     return product_name
 
 
@@ -227,69 +366,1412 @@ def extract_product_type_and_specs(cleaned_name):
 
 
 
-def clean_numeric_columns(df):
-    # Function to clean a single value (remove spaces, replace commas with dots)
-    def clean_value(value):
-        if isinstance(value, str):
-            return value.replace(' ', '').replace(',', '.')
-        return value
-
-    # Function to check if a column contains numeric-like strings
-    def is_numeric_like(col):
-        # Sample a few non-null values (up to 10) to avoid processing the entire column
-        sample = col.dropna().head(10)
-        if len(sample) == 0:  # Skip empty columns
-            return False
-        # Clean the sample values and try to convert to float
-        try:
-            cleaned_sample = [clean_value(val) for val in sample]
-            # Try converting all cleaned values to float
-            [float(val) for val in cleaned_sample]
-            return True
-        except (ValueError, TypeError):
-            return False
-
-    # Identify columns that are numeric-like (strings that can be converted to numbers)
-    numeric_cols = [col for col in df.columns if is_numeric_like(df[col])]
+def normalize_product_column(products):
+    """
+    clean_product_name and extract_product_type_and_specs for a whole column. The
+    names are factorized and the rules run as pandas .str operations over the distinct
+    names only, so the cost follows the number of unique names rather than rows.
+    Returns a frame with categorical 'продукция' and 'вид продукции' aligned with
+    `products`.
+    """
+    products = pd.Series(products)
+    codes, names = pd.factorize(products)
+    names = pd.Series(names, dtype=object)
+    present = names.notna() & (names.astype(str) != '')
+
+    cleaned = names.astype(str).str.lower().str.strip()
+    for pattern, replacement in PRODUCT_NAME_RULES:
+        cleaned = cleaned.str.replace(pattern, replacement, regex=True)
+    cleaned = cleaned.where(present, '')
+
+    # Type is the text before the first digit, spec the first token starting at it
+    parts = cleaned.str.extract(r'^(?P<type>\D*)(?P<spec>\d\S*)?', expand=True)
+    has_digit = parts['spec'].notna()
+    product_type = parts['type'].str.rstrip('., ').str.strip().where(has_digit, cleaned)
+    spec = parts['spec'].fillna('')
+
+    result = {}
+    for column, values in (('продукция', product_type), ('вид продукции', spec)):
+        value_codes, categories = pd.factorize(values)
+        # Missing input names (code -1) get the empty strings clean_product_name returns
+        if (codes < 0).any():
+            empty = categories.get_loc('') if '' in categories else len(categories)
+            if empty == len(categories):
+                categories = categories.append(pd.Index(['']))
+            value_codes = np.append(value_codes, empty)
+        result[column] = pd.Categorical.from_codes(value_codes[codes], categories=categories)
+    return pd.DataFrame(result, index=products.index)
+
+
+# Spaces used as thousands separators in exports, including the non-breaking ones 1C writes
+NUMBER_SPACES = [' ', '\u00a0', '\u202f', '\u2009']
+
+
+def parse_numbers(values):
+    """
+    Numbers written as text with space thousands separators and a decimal comma
+    ("1 234,5", "1.234,50", "1234.5"), or with thousands commas before a decimal point
+    ("12,345.67"), as floats. Everything runs vectorized on Arrow-backed strings, with
+    no Python code per value: one regex check tells a thousands comma before a decimal
+    point from a decimal comma, since a fixed-string search can't see which separator
+    comes last, and the rest are literal replacements. Unparseable values become NaN.
+    """
+    text = pd.Series(values).astype('string[pyarrow]')
+    has_comma = text.str.contains(',', regex=False).fillna(False)
+    # A dot after every comma is the decimal point and the commas separate thousands ("12,345.67")
+    thousands_comma = text.str.contains(r',.*\.[^,]*$', regex=True).fillna(False)
+    # Otherwise the last comma is the decimal one and dots can only separate thousands ("1.234,50");
+    # any other mix leaves two decimal points and fails below
+    decimal_comma = has_comma & ~thousands_comma
+    text = text.where(~thousands_comma, text.str.replace(',', '', regex=False))
+    text = text.where(~decimal_comma, text.str.replace('.', '', regex=False))
+    for space in NUMBER_SPACES:
+        text = text.str.replace(space, '', regex=False)
+    text = text.str.replace(',', '.', regex=False)
+    try:
+        # Arrow's cast is the fast path, it refuses the whole column on any bad value
+        numbers = text.astype('float64[pyarrow]')
+    except (ValueError, TypeError, pa.ArrowInvalid):
+        numbers = pd.to_numeric(text, errors='coerce')
+    return numbers.to_numpy(dtype=float, na_value=np.nan)
+
+
+def clean_numeric_columns(df, sample_size=10):
+    """
+    Convert text columns holding numbers to floats rounded to 2 decimals. A column
+    qualifies when every value of a sample of its non-null values parses; columns that
+    already have a numeric dtype are left alone. Values that fail to parse in a
+    converted column become NaN and are reported per column, also in
+    df.attrs['numeric_failures'] as {column: (count, examples)}.
+    """
+    numeric_cols = []
+    failures = {}
+    for col in df.columns:
+        column = df[col]
+        if pd.api.types.is_numeric_dtype(column) or pd.api.types.is_datetime64_any_dtype(column):
+            continue
+        # Sample a few non-null values to avoid processing the entire column
+        sample = column.dropna().head(sample_size)
+        if sample.empty or np.isnan(parse_numbers(sample)).any():
+            continue
 
-    # Apply cleaning to identified numeric columns
-    for col in numeric_cols:
         print(f"Cleaning column: {col}")
-        df[col] = df[col].astype(str).str.replace(' ', '', regex=False).str.replace(',', '.', regex=False).astype(float)
+        numbers = parse_numbers(column)
+        failed = np.isnan(numbers) & column.notna().to_numpy()
+        if failed.any():
+            failures[col] = (int(failed.sum()), column[failed].astype(str).unique()[:5].tolist())
+            print(f"  {failures[col][0]} values could not be parsed, e.g. {failures[col][1]}")
         # Round to 2 decimal places (optional, based on your previous requirement)
-        df[col] = df[col].round(2)
+        df[col] = np.round(numbers, 2)
+        numeric_cols.append(col)
     # Print the identified numeric columns
     print("Identified numeric columns:", numeric_cols)
+    df.attrs['numeric_failures'] = failures
+
+    return df
+
+
+# Matches the repr of a 2-tuple of strings as written to the export, e.g.
+# "('труба проф', '40*20*1.5')". Either quote style is accepted because repr()
+# switches to double quotes when the value itself contains a single quote.
+PRODUCT_TUPLE_RE = re.compile(
+    r"""^\(\s*(?P<q1>['"])(?P<type>.*?)(?P=q1)\s*,\s*(?P<q2>['"])(?P<spec>.*?)(?P=q2)\s*,?\s*\)$"""
+)
+
+
+def decode_product_column(products, strict=False):
+    """
+    Splits the serialized `product` tuples into the `продукция` and `вид продукции`
+    categorical columns without eval().
+
+    Product strings repeat heavily, so the regex runs only over the unique values and
+    the result is broadcast back to the rows through the factorized codes.
+    With strict=True any value that is missing or not a well-formed tuple raises
+    ValueError, otherwise such rows get NaN in both columns.
+    """
+    codes, uniques = pd.factorize(products)
+    parts = pd.Series(uniques, dtype=object).str.extract(PRODUCT_TUPLE_RE)
+
+    malformed = parts['type'].isna()
+    if strict:
+        missing = int((codes < 0).sum())
+        if malformed.any() or missing:
+            examples = ', '.join(repr(value) for value in uniques[malformed.to_numpy()][:5])
+            raise ValueError(f"Missing or malformed product values ({missing} rows missing, "
+                             f"{malformed.sum()} unique values malformed)"
+                             + (f", e.g. {examples}" if examples else ""))
+
+    decoded = {}
+    for column, part in [('продукция', 'type'), ('вид продукции', 'spec')]:
+        # Map each unique tuple onto the code of its part; -1 marks NaN/malformed rows
+        part_codes, part_uniques = pd.factorize(parts[part])
+        row_codes = np.full(len(codes), -1, dtype=part_codes.dtype)
+        row_codes[codes >= 0] = part_codes[codes[codes >= 0]]
+        decoded[column] = pd.Categorical.from_codes(row_codes, categories=part_uniques)
+
+    return pd.DataFrame(decoded, index=products.index)
+
+
+########## Chunked CSV ingestion
+# The export is parsed in fixed-size chunks that are decoded and downcast right away,
+# so peak memory stays close to the size of the typed frame instead of a multiple of
+# the raw file.
+INGEST_CHUNK_ROWS = int(os.environ.get('DASHBOARD_INGEST_CHUNK_ROWS', 200_000))
+INGEST_MEMORY_LIMIT_MB = int(os.environ.get('DASHBOARD_INGEST_MEMORY_MB', 4096))
+# Reject exports with missing or malformed product values instead of loading those rows
+# with NaN products. Exports already in the dataset cache are not checked again.
+PRODUCT_STRICT = os.environ.get('DASHBOARD_PRODUCT_STRICT', '0') == '1'
+
+
+# File types accepted for a prepared export: plain CSV or a compressed archive of it
+EXPORT_SUFFIXES = ('.csv', '.zip', '.gz', '.xz', '.zst')
+
+
+def open_csv_streams(file, name):
+    """
+    Returns (branch, stream) pairs for an uploaded export. Archives are decompressed as
+    streams, so the uncompressed CSV is never held in memory or written to disk as a whole.
+    branch is set from the member file name for multi-file zips and is None otherwise.
+    """
+    suffix = Path(name).suffix.lower()
+    if suffix == '.gz':
+        return [(None, gzip.GzipFile(fileobj=file, mode='rb'))]
+    if suffix == '.xz':
+        return [(None, lzma.LZMAFile(file, mode='rb'))]
+    if suffix == '.zst':
+        return [(None, zstandard.ZstdDecompressor().stream_reader(file))]
+    if suffix == '.zip':
+        archive = zipfile.ZipFile(file)
+        members = [member for member in archive.infolist()
+                   if not member.is_dir() and member.filename.lower().endswith('.csv')]
+        if not members:
+            raise ValueError("The archive contains no CSV files")
+        if len(members) == 1:
+            return [(None, archive.open(members[0]))]
+        return [(Path(member.filename).stem, archive.open(member)) for member in members]
+    return [(None, file)]
+
+
+def read_sales_csv(file, chunksize=None, progress=None, memory_limit_mb=None, strict=None):
+    """
+    Parses the prepared export (cp1251, ';'-separated, dates in the first column) from a
+    binary file object. The file may also be a .zip, .gz, .xz or .zst archive, detected
+    by its name; the members of a multi-file zip are merged with a `Branch` column taken
+    from each member's file name.
+
+    progress, if given, is called with the fraction of the file consumed after each chunk.
+    MemoryError is raised as soon as the typed chunks exceed memory_limit_mb.
+    strict (PRODUCT_STRICT by default) is passed on to decode_product_column.
+    """
+    chunksize = chunksize or INGEST_CHUNK_ROWS
+    strict = PRODUCT_STRICT if strict is None else strict
+    memory_limit = (memory_limit_mb or INGEST_MEMORY_LIMIT_MB) * 1024 ** 2
+
+    file.seek(0, os.SEEK_END)
+    total_size = file.tell() or 1
+    file.seek(0)
+
+    chunks = []
+    text_dtypes = None
+    raw_bytes = None
+    used_bytes = 0
+    for branch, stream in open_csv_streams(file, getattr(file, 'name', '')):
+        reader = pd.read_csv(stream, encoding="cp1251", low_memory=False, index_col=0, sep=';', parse_dates=True,
+                             chunksize=chunksize)
+        with reader:
+            for chunk in reader:
+                if branch is not None:
+                    chunk['Branch'] = branch
+                # Split the serialized (продукция, вид продукции) tuples into categorical columns
+                decoded = decode_product_column(chunk["product"], strict=strict)
+                chunk["продукция"] = decoded["продукция"]
+                chunk["вид продукции"] = decoded["вид продукции"]
+                # Memory of the columns as parsed, for the report after the merge
+                chunk_bytes = chunk.memory_usage(deep=True)
+                raw_bytes = chunk_bytes if raw_bytes is None else raw_bytes.add(chunk_bytes, fill_value=0)
+                chunk = optimize_dataframe(chunk)
+
+                # The first chunk decides which text columns are categorical and which are strings,
+                # so every chunk of a column ends up with the same dtype and can be merged without upcasting
+                if text_dtypes is None:
+                    text_dtypes = {col: 'category' if isinstance(chunk[col].dtype, pd.CategoricalDtype) else 'string[pyarrow]'
+                                   for col in chunk.select_dtypes(include=['category', 'string']).columns}
+                for col, dtype in text_dtypes.items():
+                    if chunk[col].dtype != dtype:
+                        chunk[col] = chunk[col].astype(dtype)
+
+                used_bytes += chunk.memory_usage(deep=True).sum()
+                if used_bytes > memory_limit:
+                    raise MemoryError(
+                        f"Parsed data exceeds the ingestion memory limit of {memory_limit // 1024 ** 2} MB")
+                chunks.append(chunk)
+
+                # Progress follows the position in the raw (possibly compressed) upload
+                if progress is not None:
+                    progress(min(file.tell() / total_size, 1.0))
+
+    if not chunks:
+        raise ValueError("The file contains no data rows")
+    df = add_calendar_columns(sort_by_date(concat_chunks(chunks)))
+    memory_report(raw_bytes, df.memory_usage(deep=True))
+    return df
+
+
+def concat_chunks(chunks):
+    # Concatenate column by column, releasing each column from the chunks as soon as it is
+    # merged, and union categoricals so they stay categorical in the result
+    if len(chunks) == 1:
+        return chunks[0]
+    index = chunks[0].index.append([chunk.index for chunk in chunks[1:]])
+    columns = {}
+    for col in list(chunks[0].columns):
+        parts = [chunk.pop(col) for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            try:
+                columns[col] = pd.Series(union_categoricals(parts))
+            except TypeError:
+                # Categories of different dtypes, e.g. a chunk where the column was all NaN
+                columns[col] = pd.concat([part.astype(object) for part in parts], ignore_index=True).astype('category')
+        else:
+            columns[col] = pd.concat(parts, ignore_index=True)
+        del parts
+    df = pd.DataFrame(columns)
+    df.index = index
+    return df
+
+
+########## Persistent dataset cache
+# Parsed exports are stored as uncompressed Feather (Arrow IPC) files named after the
+# SHA-256 of the uploaded bytes, so a re-upload or an app restart memory-maps the typed
+# frame instead of parsing the CSV again. Numeric columns are used straight from the
+# mapped file; text and categorical columns are still copied onto the heap. Least
+# recently used files are evicted once the directory grows past the cap.
+CACHE_DIR = Path(os.environ.get('DASHBOARD_CACHE_DIR', Path(__file__).parent / '.cache'))
+CACHE_MAX_BYTES = int(float(os.environ.get('DASHBOARD_CACHE_MAX_GB', 5)) * 1024 ** 3)
+# Bump whenever the typed frame produced by the load path changes shape or dtypes
+CACHE_FORMAT_VERSION = 6
+
+
+def file_digest(file, block_size=1024 * 1024):
+    # Hash a binary file object in blocks and rewind it for the reader
+    digest = hashlib.sha256()
+    file.seek(0)
+    for block in iter(lambda: file.read(block_size), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def cached_dataset_path(digest):
+    return CACHE_DIR / f"{digest}-v{CACHE_FORMAT_VERSION}.feather"
+
+
+def read_cached_dataset(digest):
+    path = cached_dataset_path(digest)
+    if not path.exists():
+        return None
+    table = feather.read_table(path, memory_map=True)
+    # Touch the file so eviction sees it as recently used
+    os.utime(path)
+    # With one record batch and split blocks, numeric and date columns stay read-only views
+    # of the mapped file and only text and categorical columns are copied onto the heap
+    df = table.to_pandas(split_blocks=True)
+    # The index is stored as the first column because Feather only keeps a default index
+    return df.set_index(df.columns[0])
+
+
+def write_cached_dataset(digest, df, max_bytes=None):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = cached_dataset_path(digest)
+    # Write next to the target and rename, so a crash never leaves a truncated cache file
+    tmp_path = path.with_suffix('.tmp')
+    # A single record batch, so every column is one contiguous buffer that can be mapped without a copy
+    table = pa.Table.from_pandas(df.reset_index()).combine_chunks()
+    feather.write_feather(table, tmp_path, compression='uncompressed', chunksize=max(len(table), 1))
+    os.replace(tmp_path, path)
+    remove_stale_cached_datasets()
+    evict_cached_datasets(CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+    return path
+
+
+def remove_stale_cached_datasets():
+    # Files written with an earlier CACHE_FORMAT_VERSION are never read again
+    for path in CACHE_DIR.glob('*-v*.feather'):
+        if not path.name.endswith(f"-v{CACHE_FORMAT_VERSION}.feather"):
+            path.unlink(missing_ok=True)
+            print(f"Removed stale cached dataset {path.name}")
+
+
+def evict_cached_datasets(max_bytes):
+    # Remove least recently used files until the cache fits into max_bytes
+    files = sorted(CACHE_DIR.glob('*.feather'), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in files)
+    for path in files:
+        if total <= max_bytes:
+            break
+        total -= path.stat().st_size
+        path.unlink(missing_ok=True)
+        print(f"Evicted cached dataset {path.name}")
+
+def load_dataset(file, digest, progress=None):
+    # Typed frame for an export: from the on-disk cache when these exact bytes were parsed before
+    df = read_cached_dataset(digest)
+    if df is None:
+        df = read_sales_csv(file, progress=progress)
+        write_cached_dataset(digest, df)
+    return canonicalize_products(df)
+
+
+def canonicalize_products(df):
+    # Canonical product names are applied after the cache, since the alias map keeps growing
+    if CANONICALIZE_PRODUCTS and 'продукция' in df.columns:
+        canonicalizer = ProductCanonicalizer()
+        df['продукция'] = canonicalizer.fit_transform(df['продукция'])
+        canonicalizer.save()
+    return df
+
 
+########## Raw export preprocessing
+# Raw branch exports from 1C (Excel or CSV with report title rows above the header) are
+# run through header_finder and the date, product and numeric stages, and stored as a
+# Parquet dataset partitioned by year and branch that the dashboard opens directly.
+RAW_EXPORT_SUFFIXES = ('.xlsx', '.xls', '.csv')
+# Rows of a workbook turned into a typed frame at a time
+EXCEL_CHUNK_ROWS = int(os.environ.get('DASHBOARD_EXCEL_CHUNK_ROWS', 50_000))
+# Workbook reader: 'calamine' is about 10x faster but loads the whole sheet before the first
+# row, 'openpyxl' (read-only) streams rows and keeps memory bounded by the chunk size
+EXCEL_ENGINE = os.environ.get('DASHBOARD_EXCEL_ENGINE', 'calamine' if python_calamine is not None else 'openpyxl')
+PREPARED_DATASET_DIR = os.environ.get('DASHBOARD_PREPARED_DIR')
+# Records the source files of a prepared dataset; the leading underscore hides it from Parquet readers
+PREPARED_MANIFEST = '_manifest.json'
+PREPARED_INDEX = 'Дата'
+
+
+def iter_excel_rows(path, engine=None):
+    """
+    Cell values of the first sheet of a workbook, row by row, read with `engine`
+    (EXCEL_ENGINE). calamine loads the whole sheet up front, even when only the first
+    rows are consumed; openpyxl in read-only mode parses rows as they are requested.
+    calamine falls back to openpyxl when it is not installed. Empty cells may come as
+    None or ''.
+    """
+    if (engine or EXCEL_ENGINE) == 'calamine' and python_calamine is not None:
+        yield from python_calamine.CalamineWorkbook.from_path(str(path)).get_sheet_by_index(0).iter_rows()
+        return
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _cells_frame(rows, width):
+    # Typed frame of raw rows; empty cells become NaN and the columns they made object
+    # (e.g. numbers next to the empty cells of a footer row) are inferred again
+    frame = pd.DataFrame(rows).reindex(columns=range(width))
+    return frame.replace('', None).infer_objects()
+
+
+def read_raw_export(path, encoding='cp1251', sep=';', chunk_rows=None, engine=None):
+    """
+    Data rows of a raw Excel or CSV export under the column names found by find_header
+    in its first HEADER_SEARCH_ROWS rows, as header_finder would return them.
+
+    The rows of a workbook below the header are turned into typed frames `chunk_rows`
+    (EXCEL_CHUNK_ROWS) rows at a time. With the openpyxl engine only one chunk of raw
+    cells is held in memory; calamine holds the whole sheet while reading, see
+    iter_excel_rows. A CSV gets as many columns as the widest of its top rows, since
+    the title rows are shorter than the table. Legacy .xls files need calamine.
+    """
+    path = Path(path)
+    chunk_rows = chunk_rows or EXCEL_CHUNK_ROWS
+    if path.suffix.lower() == '.csv':
+        with open(path, encoding=encoding) as file:
+            width = max((line.count(sep) + 1 for line in itertools.islice(file, HEADER_SEARCH_ROWS)), default=1)
+        options = dict(header=None, names=range(width), sep=sep, encoding=encoding, dtype=str, skip_blank_lines=False)
+        columns, data_start = find_header(pd.read_csv(path, nrows=HEADER_SEARCH_ROWS, **options))
+        df = pd.read_csv(path, skiprows=data_start, **options)
+        df.columns = columns
+        return df
+    if path.suffix.lower() == '.xls' and python_calamine is None:
+        return header_finder(pd.read_excel(path, header=None))
+
+    rows = iter_excel_rows(path, engine)
+    top = list(itertools.islice(rows, HEADER_SEARCH_ROWS))
+    columns, data_start = find_header(_cells_frame(top, max(map(len, top), default=0)))
+    chunks = []
+    pending = top[data_start:]
+    while True:
+        chunk = pending + list(itertools.islice(rows, chunk_rows - len(pending)))
+        pending = []
+        if not chunk:
+            break
+        chunks.append(_cells_frame(chunk, len(columns)))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    # A chunk whose column is all empty is object, and so is that column after the concat
+    df = pd.concat(chunks, ignore_index=True).infer_objects()
+    df.columns = columns
     return df
 
-def optimize_dataframe(df):
-    """Reduce memory usage of the DataFrame by optimizing data types"""
 
-    # Convert object types to categories when appropriate
-    for col in df.select_dtypes(include=['object']).columns:
-        # If the column has relatively few unique values, convert to category
-        if df[col].nunique() < len(df) * 0.5:  # If less than 50% of values are unique
+def preprocess_export(df, branch=None):
+    """
+    Runs the preprocessing stages over a raw export read by read_raw_export and returns
+    the frame in the dashboard's layout: a DatetimeIndex, the serialized `product`
+    tuples with their categorical `продукция` and `вид продукции`, numeric columns as
+    floats and a `Branch` column when `branch` is given. Raises ValueError when the
+    export has no date or product column.
+    """
+    date_column = find_date_column(df)
+    if date_column is None:
+        raise ValueError("No date column found")
+    df = dates_fixer(df, date_column)
+    # Rows without a date are totals and footers of the report
+    df = df[df.index.notna()]
+    df.index.name = PREPARED_INDEX
+
+    _, product_column = detect_product_column(df)
+    if product_column is None:
+        raise ValueError("No product column found")
+    products = normalize_product_column(df.pop(product_column))
+    # The tuples are written once per distinct (продукция, вид продукции) pair
+    codes, pairs = pd.factorize(pd.MultiIndex.from_frame(products))
+    df['product'] = pd.Categorical.from_codes(codes, categories=[repr(pair) for pair in pairs])
+    df['продукция'] = products['продукция'].array
+    df['вид продукции'] = products['вид продукции'].array
+
+    df = clean_numeric_columns(df)
+    if branch is not None:
+        df['Branch'] = branch
+    return df
+
+
+def prepared_files(root, name):
+    # Parquet files of the source `name` in the year/branch partitions under root
+    return Path(root).glob(f"*/*/{glob.escape(name)}-*.parquet")
+
+
+def prepared_type(arrow_type):
+    # Storage type of a column in the prepared dataset: the same for every file whatever
+    # the export, plain strings instead of dictionaries and no narrowed numbers
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pa.large_string()
+    if pa.types.is_floating(arrow_type):
+        return pa.float64()
+    if pa.types.is_integer(arrow_type):
+        return pa.int64()
+    if pa.types.is_timestamp(arrow_type):
+        return pa.timestamp('ns')
+    return arrow_type
+
+
+def write_prepared_partitions(df, root, name):
+    """
+    Writes a preprocessed export with a Branch column into the dataset at `root`, one
+    file per Год/Branch partition named after `name`, replacing the files an earlier run
+    wrote for it. Columns are stored with the types of prepared_type(), so files of all
+    exports share one schema; read_prepared_dataset() optimizes the dtypes after reading.
+    Returns the written paths relative to root.
+    """
+    for path in prepared_files(root, name):
+        path.unlink()
+    table = pa.Table.from_pandas(df.reset_index().assign(Год=df.index.year), preserve_index=False)
+    # The pandas metadata would bring back each file's own dtypes (e.g. categoricals) on read
+    table = table.replace_schema_metadata(None)
+    table = table.cast(pa.schema([field.with_type(prepared_type(field.type)) for field in table.schema]))
+    written = []
+    pq.write_to_dataset(table, root, partition_cols=['Год', 'Branch'], basename_template=f"{name}-{{i}}.parquet",
+                        existing_data_behavior='overwrite_or_ignore',
+                        file_visitor=lambda written_file: written.append(written_file.path))
+    return [str(Path(path).relative_to(root)) for path in written]
+
+
+def prepared_dataset_digest(root):
+    # The manifest changes whenever a source file does, so its hash identifies the dataset
+    with open(Path(root) / PREPARED_MANIFEST, 'rb') as file:
+        return file_digest(file)
+
+
+def read_prepared_dataset(root):
+    # Year and branch come back from the partition directories; Год is rebuilt with the calendar keys.
+    # Exports may have different columns, so the dataset gets the union of the files' schemas.
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()]
+                              + [dataset.partitioning.schema])
+    df = ds.dataset(root, schema=schema, format='parquet', partitioning='hive').to_table().to_pandas()
+    df = df.drop(columns='Год').set_index(PREPARED_INDEX)
+    return add_calendar_columns(sort_by_date(optimize_dataframe(df)))
+
+
+def load_prepared_dataset(root):
+    return canonicalize_products(read_prepared_dataset(root))
+
+
+########## Product canonicalization
+# Variant spellings of one product ("труба проф" / "труба профильная") are merged into a
+# canonical name. Names are only compared within a block sharing the start of the first
+# two words and all sizes, and the alias map is kept on disk so each export only has to
+# match the names it adds.
+CANONICALIZE_PRODUCTS = os.environ.get('DASHBOARD_CANONICALIZE_PRODUCTS', '0') == '1'
+PRODUCT_ALIASES_PATH = os.environ.get('DASHBOARD_PRODUCT_ALIASES')
+# Minimum similarity (0-100) of the token-sorted names of a block to be the same product
+PRODUCT_MATCH_THRESHOLD = 90
+# Names shorter than this are only merged as abbreviations: on a short name the threshold
+# allows a single edit, which already turns "трубка" into "труба"
+PRODUCT_FUZZY_MIN_LENGTH = 12
+
+
+def product_block_key(name):
+    # First three letters of the first two words, so typos further in still share a block,
+    # plus every word with a digit: sizes and grades must match exactly
+    words = name.split()
+    return (tuple(word[:3] for word in words[:2]),
+            tuple(sorted(word for word in words if any(char.isdigit() for char in word))))
+
+
+def is_abbreviation(words, other_words):
+    # Same number of words and each word equal to the other's or a prefix (3+ letters) of it
+    return len(words) == len(other_words) and all(
+        a == b or (min(len(a), len(b)) >= 3 and (a.startswith(b) or b.startswith(a)))
+        for a, b in zip(words, other_words))
+
+
+class ProductCanonicalizer:
+    """
+    Persistent map from product names to canonical names.
+
+    fit() assigns every name not seen before to a canonical name of its block (see
+    product_block_key): one it abbreviates or is abbreviated by ("труба проф" /
+    "труба профильная"), found through an index on the words' first three letters, or
+    else the most similar one by Levenshtein.ratio of the names with their words sorted,
+    of at least `threshold` / 100. That similarity fallback only compares names of at
+    least PRODUCT_FUZZY_MIN_LENGTH characters, shorter ones match only as abbreviations.
+    Names without a match become canonical themselves; with `counts`, more frequent
+    names go first and so become the canonical spelling. The map
+    is stored as JSON at `path` (PRODUCT_ALIASES_PATH, or product_aliases.json in CACHE_DIR).
+    """
+
+    def __init__(self, path=None, threshold=PRODUCT_MATCH_THRESHOLD):
+        self.path = Path(path or PRODUCT_ALIASES_PATH or CACHE_DIR / 'product_aliases.json')
+        self.threshold = threshold
+        self.aliases = {}
+        if self.path.exists():
+            with open(self.path, encoding='utf-8') as file:
+                self.aliases = json.load(file)['aliases']
+        # Similarity index over the canonical names: token-sorted spellings per block and
+        # canonical names per tuple of word prefixes
+        self._blocks = {}
+        self._prefixes = {}
+        for canonical in dict.fromkeys(self.aliases.values()):
+            self._index(canonical)
+
+    def _index(self, canonical):
+        words = canonical.split()
+        block = self._blocks.setdefault(product_block_key(canonical), ([], []))
+        block[0].append(canonical)
+        block[1].append(' '.join(sorted(words)))
+        self._prefixes.setdefault(tuple(word[:3] for word in words), []).append(canonical)
+
+    def _match(self, name):
+        words = name.split()
+        block_key = product_block_key(name)
+        for canonical in self._prefixes.get(tuple(word[:3] for word in words), []):
+            if is_abbreviation(words, canonical.split()) and product_block_key(canonical) == block_key:
+                return canonical
+        canonicals, sorted_names = self._blocks.get(block_key, ([], []))
+        if not canonicals:
+            return None
+        sorted_name = ' '.join(sorted(words))
+        if len(sorted_name) < PRODUCT_FUZZY_MIN_LENGTH:
+            return None
+        scores = [Levenshtein.ratio(sorted_name, other) if len(other) >= PRODUCT_FUZZY_MIN_LENGTH else 0.0
+                  for other in sorted_names]
+        best = int(np.argmax(scores))
+        return canonicals[best] if scores[best] * 100 >= self.threshold else None
+
+    def fit(self, names, counts=None):
+        names = pd.Series(names, dtype=object).dropna().astype(str)
+        if counts is None:
+            counts = names.value_counts()
+        else:
+            counts = pd.Series(counts, index=names).groupby(level=0).sum().sort_values(ascending=False)
+        new_names = [name for name in counts.index if name not in self.aliases]
+        for name in new_names:
+            canonical = self._match(name)
+            if canonical is None:
+                canonical = name
+                self._index(name)
+            self.aliases[name] = canonical
+        return len(new_names)
+
+    def transform(self, products):
+        # Categorical of canonical names; only the categories are looked up
+        products = pd.Series(products)
+        categorical = products.astype('category')
+        categories = categorical.cat.categories
+        canonical = pd.Index([self.aliases.get(name, name) for name in categories.astype(str)])
+        canonical_codes, canonical_names = pd.factorize(canonical)
+        codes = categorical.cat.codes.to_numpy()
+        codes = np.where(codes >= 0, canonical_codes[codes], -1)
+        return pd.Series(pd.Categorical.from_codes(codes, categories=canonical_names), index=products.index,
+                         name=products.name)
+
+    def fit_transform(self, products):
+        products = pd.Series(products)
+        counts = products.value_counts()
+        self.fit(counts.index, counts.to_numpy())
+        return self.transform(products)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'version': 1, 'aliases': self.aliases}, file, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+########## Price outlier bounds
+# Strategies offered by the price tab for dropping outlier prices
+OUTLIER_STRATEGIES = {
+    'mad': 'Медиана ± 5 MAD',
+    'iqr': 'Квартили ± 3 IQR',
+    'mean6': 'До 6 × средней цены продукции',
+    'none': 'Без фильтрации',
+}
+OUTLIER_MAD_K = 5
+OUTLIER_IQR_K = 3
+
+
+class PriceBounds:
+    """
+    Outlier bounds of `Цена` for every продукция x вид продукции, computed once per dataset.
+
+    `table` has one row per group with a low and high bound per strategy:
+    median ± OUTLIER_MAD_K scaled MADs, quartiles ± OUTLIER_IQR_K IQRs, and the legacy
+    cap of 6 x the mean price of the product. `codes` maps each row of the frame to its
+    group, so filtering is one comparison against the bounds taken by code.
+    """
+
+    def __init__(self, df):
+        keys = [col for col in ('продукция', 'вид продукции') if col in df.columns]
+        self.price = df['Цена'].to_numpy(dtype=float)
+        self.codes = df.groupby(keys, observed=True, dropna=False).ngroup().to_numpy(np.int32)
+        self._masks = {}
+
+        first_rows = np.unique(self.codes, return_index=True)[1]
+        table = df[keys].iloc[first_rows].reset_index(drop=True)
+        grouped = pd.Series(self.price).groupby(self.codes)
+        quartiles = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+        median = quartiles[0.5].to_numpy()
+        mad = 1.4826 * pd.Series(np.abs(self.price - median[self.codes])).groupby(self.codes).median().to_numpy()
+        iqr = (quartiles[0.75] - quartiles[0.25]).to_numpy()
+        # A group where most deals share one price has no spread: it gets no bounds
+        # rather than losing every other deal
+        mad = np.where(mad > 0, mad, np.inf)
+        iqr = np.where(iqr > 0, iqr, np.inf)
+        table['mad_low'] = median - OUTLIER_MAD_K * mad
+        table['mad_high'] = median + OUTLIER_MAD_K * mad
+        table['iqr_low'] = quartiles[0.25].to_numpy() - OUTLIER_IQR_K * iqr
+        table['iqr_high'] = quartiles[0.75].to_numpy() + OUTLIER_IQR_K * iqr
+        table['mean6_low'] = -np.inf
+        if 'продукция' in keys:
+            product_mean = pd.Series(self.price).groupby(df['продукция'].to_numpy()).mean()
+            table['mean6_high'] = 6 * table['продукция'].astype(object).map(product_mean).astype(float).fillna(np.inf).to_numpy()
+        else:
+            table['mean6_high'] = 6 * np.nanmean(self.price)
+        table['none_low'] = -np.inf
+        table['none_high'] = np.inf
+        self.table = table
+
+    def mask(self, strategy):
+        # Rows whose price lies within the strategy's bounds (missing prices never do);
+        # built once per strategy and shared read-only
+        if strategy not in self._masks:
+            low = self.table[f'{strategy}_low'].to_numpy()[self.codes]
+            high = self.table[f'{strategy}_high'].to_numpy()[self.codes]
+            mask = (self.price >= low) & (self.price <= high)
+            mask.flags.writeable = False
+            self._masks[strategy] = mask
+        return self._masks[strategy]
+
+
+########## Pre-aggregated sales cube
+# Sums at the finest grain the pages need, month x product x spec x warehouse x branch.
+# The dimensions are small (hundreds of products, a few warehouses, tens of months), so
+# rolling up the cube costs the same no matter how many transactions were loaded.
+CUBE_DIMENSIONS = ['ГодМесяц', 'продукция', 'вид продукции', 'Склад', 'Branch']
+# Row masks of recent multiselect filters kept per dataset, one byte per row each
+ISIN_MASK_CACHE_SIZE = int(os.environ.get('DASHBOARD_ISIN_MASK_CACHE_SIZE', 16))
+CUBE_METRICS = ['Сумма', 'Количество', 'Count']
+
+
+class SalesCube:
+    """
+    Sums of `Сумма` and `Количество`, transaction counts (`Count`) and the sum, sum of
+    squares and count of `Цена` per cell of CUBE_DIMENSIONS, with `Год` and `ГодЧетверть`
+    derived from the month key for coarser roll-ups. `price_bounds` holds the dataset's
+    PriceBounds.
+    """
+
+    def __init__(self, df):
+        self.dimensions = [col for col in CUBE_DIMENSIONS if col in df.columns]
+        # Summed in float64 whatever the storage dtype, so totals do not depend on it
+        work = df[self.dimensions].copy()
+        work['Сумма'] = df['Сумма'].astype('float64')
+        work['Количество'] = df['Количество'].astype('float64')
+        aggregations = {
+            'Сумма': ('Сумма', 'sum'),
+            'Количество': ('Количество', 'sum'),
+            'Count': ('Сумма', 'size'),
+        }
+        if 'Цена' in df.columns:
+            work['Цена'] = df['Цена'].astype('float64')
+            work['Цена_кв'] = work['Цена'] ** 2
+            aggregations.update({
+                'Цена_сумма': ('Цена', 'sum'),
+                'Цена_кв_сумма': ('Цена_кв', 'sum'),
+                'Цена_n': ('Цена', 'count'),
+            })
+        # dropna=False keeps rows with missing dimensions, so totals match the raw rows
+        table = work.groupby(self.dimensions, observed=True, dropna=False).agg(**aggregations).reset_index()
+        table['Год'] = table['ГодМесяц'] // 100
+        table['ГодЧетверть'] = table['Год'] * 10 + (table['ГодМесяц'] % 100 - 1) // 3 + 1
+        self.table = table
+
+        # First and last timestamp of every month, to tell whether a date range covers whole months
+        months = df['ГодМесяц'].to_numpy()
+        self.first_seen = pd.Series(df.index).groupby(months).min()
+        self.last_seen = pd.Series(df.index).groupby(months).max()
+
+        # Outlier bounds are built with the cube, at load time
+        self.price_bounds = PriceBounds(df) if 'Цена' in df.columns else None
+
+        # Filter masks live with the dataset, so they are dropped when the registry evicts it
+        self._df = df
+        self._isin_masks = OrderedDict()
+        self._isin_lock = threading.Lock()
+
+    def isin_mask(self, column, values):
+        """
+        Read-only row mask of `column` for the sorted tuple of selected `values`, shared by
+        every session filtering the dataset the same way. The ISIN_MASK_CACHE_SIZE most
+        recently used masks are kept.
+        """
+        key = (column, values)
+        with self._isin_lock:
+            if key in self._isin_masks:
+                self._isin_masks.move_to_end(key)
+                return self._isin_masks[key]
+        mask = self._df[column].isin(list(values)).to_numpy()
+        mask.flags.writeable = False
+        with self._isin_lock:
+            self._isin_masks[key] = mask
+            while len(self._isin_masks) > ISIN_MASK_CACHE_SIZE:
+                self._isin_masks.popitem(last=False)
+        return mask
+
+    def select(self, filters, metrics):
+        """
+        Cube rows matching a DatasetView's filters, or None when the filters cannot be
+        answered from the cube (an unknown column, a notna filter or a date range
+        splitting a month).
+        """
+        mask = np.ones(len(self.table), dtype=bool)
+        for key in filters:
+            if key[0] == 'dates':
+                month_mask = self._month_mask(pd.Timestamp(key[1]), pd.Timestamp(key[2]))
+                if month_mask is None:
+                    return None
+                mask &= month_mask
+            elif key[0] == 'notna':
+                # The filter drops whole rows, including the metrics of rows where only another
+                # column is missing, and the cube cannot tell those rows apart
+                return None
+            elif key[0] in self.table.columns:
+                mask &= self.table[key[0]].isin(list(key[1])).to_numpy()
+            else:
+                return None
+        return self.table[mask]
+
+    def _month_mask(self, start, end):
+        months = self.table['ГодМесяц'].to_numpy()
+        start_month = start.year * 100 + start.month
+        end_month = end.year * 100 + end.month
+        # The boundary months may only be cut where they have no rows
+        if start_month in self.first_seen.index and self.first_seen[start_month] < start:
+            return None
+        if end_month in self.last_seen.index and self.last_seen[end_month] > end:
+            return None
+        return (months >= start_month) & (months <= end_month)
+
+
+########## Process-wide dataset store
+# All sessions of the server process share one immutable frame per uploaded dataset,
+# keyed by its content digest; a session keeps only its filter state (DatasetView).
+DATASET_IDLE_SECONDS = int(float(os.environ.get('DASHBOARD_DATASET_IDLE_MINUTES', 30)) * 60)
+
+
+class DatasetRegistry:
+    """
+    Reference-counted store of loaded datasets.
+
+    Each entry holds the frame and its SalesCube and records the sessions currently using it. Sessions that closed are
+    pruned on every access, and entries nobody used for DATASET_IDLE_SECONDS are
+    dropped. Frames handed out by acquire() are shared and must not be modified.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._entries = {}
+
+    def acquire(self, digest, session_id, loader, name=''):
+        # Loads are serialized per digest, so two sessions uploading the same file parse it once
+        with self._lock:
+            load_lock = self._load_locks.setdefault(digest, threading.Lock())
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(digest)
+            if entry is None:
+                df = loader()
+                cube = SalesCube(df)
+                entry = {
+                    'df': df,
+                    'cube': cube,
+                    'name': name,
+                    'rows': len(df),
+                    'columns': len(df.columns),
+                    'bytes': int(df.memory_usage(deep=True).sum() + cube.table.memory_usage(deep=True).sum()),
+                    'sessions': set(),
+                    'last_used': time.time(),
+                }
+                with self._lock:
+                    self._entries[digest] = entry
+
+        with self._lock:
+            # A session works with one dataset at a time
+            for other_digest, other in self._entries.items():
+                if other_digest != digest:
+                    other['sessions'].discard(session_id)
+            entry['sessions'].add(session_id)
+            entry['last_used'] = time.time()
+        self.evict_idle()
+        return entry['df'], entry['cube']
+
+    def evict_idle(self, idle_seconds=None):
+        idle_seconds = DATASET_IDLE_SECONDS if idle_seconds is None else idle_seconds
+        now = time.time()
+        with self._lock:
+            for digest, entry in list(self._entries.items()):
+                entry['sessions'] = {sid for sid in entry['sessions'] if is_active_session(sid)}
+                if entry['sessions']:
+                    entry['last_used'] = now
+                elif now - entry['last_used'] >= idle_seconds:
+                    del self._entries[digest]
+                    self._load_locks.pop(digest, None)
+                    print(f"Evicted idle dataset {entry['name']} ({digest[:12]})")
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return [{
+                'digest': digest[:12],
+                'name': entry['name'],
+                'rows': entry['rows'],
+                'columns': entry['columns'],
+                'memory_mb': entry['bytes'] / 1024 ** 2,
+                'sessions': len(entry['sessions']),
+                'idle_minutes': (now - entry['last_used']) / 60,
+            } for digest, entry in self._entries.items()]
+
+
+@st.cache_resource
+def dataset_registry():
+    return DatasetRegistry()
+
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def is_active_session(session_id):
+    # Outside a running server (scripts, tests) every session counts as active
+    if not runtime.exists():
+        return True
+    return runtime.get_instance().is_active_session(session_id)
+
+
+# Text columns whose share of distinct values in a sample is below CATEGORY_MAX_RATIO
+# become categoricals, the rest Arrow-backed strings. Other floats are stored as float32
+# only when neither a value nor the column total moves by more than FLOAT32_TOLERANCE,
+# i.e. half a tiyn for ₸ amounts.
+OPTIMIZE_SAMPLE_ROWS = 10_000
+CATEGORY_MAX_RATIO = 0.5
+FLOAT32_TOLERANCE = 0.005
+# Amounts, quantities and prices are summed and averaged, they always stay float64
+FLOAT64_COLUMNS = ('Сумма', 'Количество', 'Цена', 'Цена по прайсу')
+
+
+def optimize_dataframe(df, sample_size=OPTIMIZE_SAMPLE_ROWS, report=False):
+    """
+    Reduce memory usage of the DataFrame by optimizing data types in place.
+
+    Cardinality is estimated from a random sample of at most `sample_size` rows instead
+    of a full nunique() per column. Integers are downcast to the smallest type holding
+    their range. With report=True a per-column before/after memory table is printed.
+    """
+    before = df.memory_usage(deep=True) if report else None
+    sample = df.sample(n=sample_size, random_state=0) if len(df) > sample_size else df
+
+    for col in df.select_dtypes(include=['object', 'string']).columns:
+        values = sample[col].dropna()
+        if len(values) and values.nunique() < len(values) * CATEGORY_MAX_RATIO:
             df[col] = df[col].astype('category')
+        else:
+            df[col] = df[col].astype('string[pyarrow]')
 
-    # Downcast numeric columns
-    for col in df.select_dtypes(include=['int']).columns:
+    for col in df.select_dtypes(include=['integer']).columns:
         df[col] = pd.to_numeric(df[col], downcast='integer')
 
-    for col in df.select_dtypes(include=['float']).columns:
-        df[col] = pd.to_numeric(df[col], downcast='float')
+    for col in df.select_dtypes(include=['float64']).columns.difference(FLOAT64_COLUMNS, sort=False):
+        values = df[col].to_numpy()
+        narrow = values.astype(np.float32)
+        # Integer-valued amounts are exact in float32 one by one, but not summed in float32
+        total_error = abs(float(np.nansum(narrow)) - np.nansum(values))
+        if not (np.nanmax(np.abs(narrow - values), initial=0) > FLOAT32_TOLERANCE or total_error > FLOAT32_TOLERANCE):
+            df[col] = narrow
+
+    if report:
+        memory_report(before, df.memory_usage(deep=True))
+    return df
+
+
+def memory_report(before, after):
+    # Print the memory of each column before and after optimization, in MB
+    # Columns added after parsing, like the calendar keys, have no "before" and no ratio
+    table = pd.DataFrame({'before': before.reindex(after.index), 'after': after}) / 1024 ** 2
+    table.loc['total'] = table.sum()
+    table['ratio'] = table['before'] / table['after']
+    print(table.round(2).to_string(na_rep='-'))
+    return table
+
 
+# Period keys are stored as integers so grouping hashes small ints instead of strings:
+# Год 2024, ГодМесяц 202401, ГодЧетверть 20241. Strings are built only for display.
+PERIOD_LABELS = {
+    'Год': lambda code: f"{code}",
+    'ГодМесяц': lambda code: f"{code // 100}-{code % 100:02d}",
+    'ГодЧетверть': lambda code: f"{code // 10}-Q{code % 10}",
+}
+
+
+def sort_by_date(df):
+    # Rows in date order, sorted once at load time so date ranges are found by binary search
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index(kind='stable')
     return df
 
-def time_selector(branch_df):
+
+def is_date_sorted(index):
+    # pandas caches monotonicity on the index object, so this is computed once per dataset.
+    # Missing dates are sorted last and make it False, date filters then fall back to masks.
+    return isinstance(index, pd.DatetimeIndex) and index.is_monotonic_increasing
+
+
+def add_calendar_columns(df):
+    # Vectorized calendar components of the DatetimeIndex, computed once at load time.
+    # Nullable integers are used only when the index has missing dates.
+    has_nat = df.index.hasnans
+    year = df.index.year
+    month = df.index.month
+    quarter = df.index.quarter
+    calendar = {
+        'Год': (year, 16),
+        'Месяц': (month, 8),
+        'Четверть': (quarter, 8),
+        'ГодМесяц': (year * 100 + month, 32),
+        'ГодЧетверть': (year * 10 + quarter, 16),
+    }
+    for col, (values, bits) in calendar.items():
+        values = np.asarray(values)
+        df[col] = pd.array(values, dtype=f"Int{bits}") if has_nat else values.astype(f"int{bits}")
+    return df
+
+
+def format_period_labels(codes, period_col):
+    # Display labels for integer period keys, e.g. 202401 -> '2024-01', 20241 -> '2024-Q1'
+    return [PERIOD_LABELS[period_col](int(code)) for code in codes]
+
+
+########## Display formatting
+# Whole-column formatters for hover text, labels and tables. They work on NumPy string
+# arrays and on the unique values of a column, so no Python code runs per row.
+# Variable-width StringDType arrays convert to pandas strings far faster than fixed-width ones.
+TEXT_DTYPE = np.dtypes.StringDType()
+
+def _as_text(values, text):
+    # Line the result up with the frame the values came from: a column keeps its index,
+    # and an index (e.g. the dates) becomes the index of the result
+    if isinstance(values, pd.Series):
+        return pd.Series(text, index=values.index)
+    return pd.Series(text, index=values if isinstance(values, pd.Index) else None)
+
+
+def format_numbers(values, decimals=0, unit='', separator=','):
+    """
+    Numbers as thousands-separated strings, like f"{value:,.{decimals}f} {unit}",
+    for a whole column at once. Pass separator='' for f"{value:.{decimals}f}".
+    Missing values become empty strings.
+    """
+    numbers = np.asarray(values, dtype=float)
+    finite = np.isfinite(numbers)
+    scaled = np.round(np.abs(np.where(finite, numbers, 0)) * 10 ** decimals).astype(np.int64)
+    whole, fraction = np.divmod(scaled, 10 ** decimals)
+
+    # Integer part built three digits at a time from the lowest group up; each time a
+    # higher group is put in front, the text behind it is zero-padded to full width
+    text = (whole % 1000 if separator else whole).astype(TEXT_DTYPE)
+    group = 1
+    while separator and (whole >= 1000 ** group).any():
+        digits = (whole // 1000 ** group % 1000).astype(TEXT_DTYPE)
+        width = (3 + len(separator)) * group - len(separator)
+        text = np.where(whole >= 1000 ** group,
+                        np.strings.add(np.strings.add(digits, separator), np.strings.zfill(text, width)),
+                        text)
+        group += 1
+
+    if decimals:
+        text = np.strings.add(np.strings.add(text, '.'), np.strings.zfill(fraction.astype(TEXT_DTYPE), decimals))
+    text = np.where((numbers < 0) & (scaled > 0), np.strings.add('-', text), text)
+    if unit:
+        text = np.strings.add(text, ' ' + unit)
+    return _as_text(values, np.where(finite, text, ''))
+
+
+def format_dates(dates, fmt='%d.%m.%Y'):
+    # strftime runs on the distinct dates only, then the strings are spread back by code.
+    # Without time fields in fmt, timestamps are first truncated to days.
+    dates_index = pd.DatetimeIndex(dates)
+    if not any(field in fmt for field in ('%H', '%I', '%M', '%S', '%f', '%p', '%X', '%c')):
+        dates_index = dates_index.floor('D')
+    codes, uniques = pd.factorize(dates_index)
+    text = np.asarray(uniques.strftime(fmt), dtype=TEXT_DTYPE)
+    return _as_text(dates, np.where(codes >= 0, text[codes] if len(text) else '', ''))
+
+
+def truncate_labels(labels, width=10):
+    # 'Труба профильная' -> 'Труба проф...' for labels longer than width
+    labels = pd.Series(labels, dtype=str)
+    return labels.where(labels.str.len() <= width, labels.str.slice(0, width) + '...')
+
+
+class DatasetView:
+    """
+    Filtered view over the uploaded dataset.
+
+    The view keeps a reference to the one base frame plus a boolean row mask, so
+    filters by branch, warehouse, product, spec or date compose without copying rows.
+    Data is materialized only by frame(), and only for the columns a chart asks for.
+    `digest` identifies the base frame and `filters` records the applied filters as a
+    hashable tuple, together they make cache keys for results computed from the view.
+    aggregate() answers sums from the dataset's SalesCube whenever the filters allow it.
+
+    On a base frame sorted by date (see sort_by_date) date ranges are not masks but a
+    range `rows` of row positions found by binary search, and the rows outside it are
+    never touched.
+    """
+
+    def __init__(self, base, mask=None, filters=(), digest=None, cube=None, rows=None):
+        self.base = base
+        self.mask = mask
+        self.filters = filters
+        self.digest = digest
+        self.cube = cube
+        self.rows = rows
+
+    def _narrow(self, mask, key):
+        if self.mask is not None:
+            mask = self.mask & mask
+        return DatasetView(self.base, mask, self.filters + (key,), self.digest, self.cube, self.rows)
+
+    def _select(self, values):
+        # Entries of `values`, aligned with the base rows, that are in the view
+        if self.rows is not None:
+            rows = slice(*self.rows)
+            values = values.iloc[rows] if isinstance(values, pd.Series) else values[rows]
+        mask = self._row_mask()
+        return values if mask is None else values[mask]
+
+    def _row_mask(self):
+        if self.mask is None or self.rows is None:
+            return self.mask
+        return self.mask[self.rows[0]:self.rows[1]]
+
+    def isin(self, column, values):
+        # An empty selection means "no filter", like the multiselects on the pages
+        if values is None or len(values) == 0:
+            return self
+        values = tuple(sorted(values, key=str))
+        if self.cube is None:
+            mask = self.base[column].isin(values).to_numpy()
+        else:
+            mask = self.cube.isin_mask(column, values)
+        return self._narrow(mask, (column, values))
+
+    def notna(self, columns):
+        return self._narrow(self.base[columns].notna().all(axis=1).to_numpy(), ('notna', tuple(columns)))
+
+    def between_dates(self, start, end):
+        # Both ends are inclusive
+        index = self.base.index
+        key = ('dates', str(start), str(end))
+        if not is_date_sorted(index):
+            return self._narrow((index >= start) & (index <= end), key)
+        first, stop = self.rows or (0, len(index))
+        first = max(first, int(index.searchsorted(start, side='left')))
+        stop = max(first, min(stop, int(index.searchsorted(end, side='right'))))
+        return DatasetView(self.base, self.mask, self.filters + (key,), self.digest, self.cube, (first, stop))
+
+    def without_price_outliers(self, strategy):
+        # Outlier bounds come with the dataset's cube; a view without one builds them here
+        bounds = self.cube.price_bounds if self.cube is not None else None
+        if bounds is None:
+            bounds = PriceBounds(self.base)
+        return self._narrow(bounds.mask(strategy), ('outliers', strategy))
+
+    def __len__(self):
+        mask = self._row_mask()
+        if mask is not None:
+            return int(mask.sum())
+        return len(self.base) if self.rows is None else self.rows[1] - self.rows[0]
+
+    @property
+    def columns(self):
+        return self.base.columns
+
+    @property
+    def index(self):
+        return self._select(self.base.index)
+
+    def date_bounds(self):
+        # First and last date in the view; on a date-sorted base, the dates of its first and last rows
+        index = self.base.index
+        if not is_date_sorted(index):
+            dates = self.index
+            return dates.min(), dates.max()
+        first, stop = self.rows or (0, len(index))
+        mask = self._row_mask()
+        if mask is not None:
+            if not mask.any():
+                return pd.NaT, pd.NaT
+            first, stop = first + int(mask.argmax()), stop - int(mask[::-1].argmax())
+        if first >= stop:
+            return pd.NaT, pd.NaT
+        return index[first], index[stop - 1]
+
+    def unique(self, column):
+        # Values of a column that occur in the view, in order of first appearance
+        series = self.base[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes = pd.unique(self._select(series.cat.codes.to_numpy()))
+            return series.cat.categories.take(codes[codes >= 0]).tolist()
+        return self._select(series).dropna().unique().tolist()
+
+    def frame(self, columns=None):
+        # Materialize the selected rows, restricted to `columns` when given. A date range
+        # alone slices the base frame without copying it.
+        df = self.base if columns is None else self.base[list(columns)]
+        if self.rows is not None:
+            df = df.iloc[self.rows[0]:self.rows[1]]
+        mask = self._row_mask()
+        return df if mask is None else df[mask]
+
+    def aggregate(self, by, metrics):
+        """
+        Sums of `metrics` (any of CUBE_METRICS, 'Count' is the number of transactions) per
+        `by`, a column name or list of them. Rolled up from the cube when possible and
+        grouped over the raw rows otherwise.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        metrics = [metrics] if isinstance(metrics, str) else list(metrics)
+        cells = None
+        if self.cube is not None and all(col in self.cube.table.columns for col in by):
+            cells = self.cube.select(self.filters, metrics)
+        if cells is not None:
+            return cells.groupby(by, observed=True)[metrics].sum()
+
+        sums = [metric for metric in metrics if metric != 'Count']
+        grouped = self.frame(by + sums).groupby(by, observed=True)
+        result = grouped[sums].sum() if sums else pd.DataFrame(index=grouped.size().index)
+        if 'Count' in metrics:
+            result['Count'] = grouped.size()
+        return result[metrics]
+
+    def cached_aggregate(self, by, metrics):
+        # aggregate() memoized in a bounded LRU on (digest, filters, by, metrics)
+        if self.digest is None:
+            return self.aggregate(by, metrics)
+        by = (by,) if isinstance(by, str) else tuple(by)
+        metrics = (metrics,) if isinstance(metrics, str) else tuple(metrics)
+        return _cached_view_aggregate(self.digest, self.filters, by, metrics, self)
+
+
+# Corner order of one box: bottom square 0-3, then top square 4-7 above it
+BOX_CORNERS_X = np.array([0, 1, 1, 0, 0, 1, 1, 0])
+BOX_CORNERS_Y = np.array([0, 0, 1, 1, 0, 0, 1, 1])
+BOX_CORNERS_Z = np.array([0, 0, 0, 0, 1, 1, 1, 1])
+# Two triangles per side: bottom, top, front, right, back, left
+BOX_TRIANGLES = np.array([
+    [0, 1, 2], [0, 2, 3], [4, 5, 6], [4, 6, 7],
+    [0, 1, 5], [0, 5, 4], [1, 2, 6], [1, 6, 5],
+    [2, 3, 7], [2, 7, 6], [3, 0, 4], [3, 4, 7],
+])
+# Outline drawn around each box: top square plus the four vertical edges
+BOX_EDGES = [4, 5, 6, 7, 4, None, 0, 4, None, 1, 5, None, 2, 6, None, 3, 7, None]
+
+
+def bar3d_traces(values, labels, hover_text, colors, bar_width=0.7):
+    """
+    3D bar chart laid out on a square grid as three traces whatever the number of bars:
+    one Mesh3d with every box, one line trace with the box outlines and one text trace
+    with the labels and hover text. Vertex and face arrays are built with NumPy
+    broadcasting.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    grid_size = max(int(np.ceil(np.sqrt(n))), 1)
+    x_pos = np.arange(n) % grid_size
+    y_pos = np.arange(n) // grid_size
+
+    # (n, 8) vertex coordinates, flattened bar by bar
+    x = (x_pos[:, None] + BOX_CORNERS_X * bar_width).ravel()
+    y = (y_pos[:, None] + BOX_CORNERS_Y * bar_width).ravel()
+    z = (values[:, None] * BOX_CORNERS_Z).ravel()
+    # (n * 12, 3) triangles, offset into each bar's block of 8 vertices
+    faces = (BOX_TRIANGLES[None, :, :] + 8 * np.arange(n)[:, None, None]).reshape(-1, 3)
+
+    # Bar colors go in as numeric codes on a stepped colorscale, so the payload carries
+    # one small number per face instead of a color string
+    color_codes, palette = pd.factorize(pd.Series(colors, dtype=object))
+    colorscale = [[position, color] for code, color in enumerate(palette)
+                  for position in (code / len(palette), (code + 1) / len(palette))]
+    mesh = go.Mesh3d(
+        x=x, y=y, z=z,
+        i=faces[:, 0], j=faces[:, 1], k=faces[:, 2],
+        intensity=np.repeat(color_codes, len(BOX_TRIANGLES)),
+        intensitymode='cell',
+        colorscale=colorscale,
+        cmin=-0.5,
+        cmax=len(palette) - 0.5,
+        showscale=False,
+        flatshading=True,
+        hoverinfo='skip',
+        showlegend=False
+    )
+
+    # Outline points with None breaks between segments, indexing the vertex arrays
+    edge_index = np.array([-1 if corner is None else corner for corner in BOX_EDGES])
+    edge_vertices = (edge_index[None, :] + 8 * np.arange(n)[:, None]).ravel()
+    breaks = np.tile(edge_index < 0, n)
+    edge_coords = [np.where(breaks, None, coord[np.where(breaks, 0, edge_vertices)].astype(object))
+                   for coord in (x, y, z)]
+    outline = go.Scatter3d(
+        x=edge_coords[0], y=edge_coords[1], z=edge_coords[2],
+        mode='lines',
+        line=dict(color='rgba(40,40,40,0.6)', width=2),
+        hoverinfo='skip',
+        showlegend=False
+    )
+
+    text = go.Scatter3d(
+        x=x_pos + bar_width / 2,
+        y=y_pos + bar_width / 2,
+        z=values * 1.05,  # Slightly above the bar
+        mode='text',
+        text=list(labels),
+        textposition='top center',
+        textfont=dict(
+            size=16,  # Increase font size (default is 12)
+            family="Times New Roman Bold"  # Use a bold font family
+        ),
+        # Hover sits on the label above each bar, once per bar rather than per vertex
+        hovertext=list(hover_text),
+        hoverinfo='text',
+        showlegend=False
+    )
+    return [mesh, outline, text], grid_size
+
+
+# Above this many transactions the price/quantity scatter is binned on the server
+SCATTER_MAX_POINTS = int(os.environ.get('DASHBOARD_SCATTER_MAX_POINTS', 5000))
+
+
+def bin_price_quantity(quantity, price, bins=60):
+    """
+    Server-side density of the price/quantity scatter: transactions are counted on a
+    bins x bins grid, logarithmic in quantity and linear in price. Returns one row per
+    occupied cell with the mean position of its deals, the deal count and the cell bounds.
+    """
+    quantity = np.asarray(quantity, dtype=float)
+    price = np.asarray(price, dtype=float)
+    keep = np.isfinite(quantity) & np.isfinite(price)
+    quantity, price = quantity[keep], price[keep]
+    if not len(quantity):
+        return pd.DataFrame(columns=['Количество', 'Цена', 'Сделок', 'Кол_от', 'Кол_до', 'Цена_от', 'Цена_до'])
+
+    # Zero and negative quantities have no logarithm, they are put in the first column
+    positive = quantity[quantity > 0]
+    log_quantity = np.log10(np.maximum(quantity, positive.min() if len(positive) else 1.0))
+    x_edges = np.linspace(log_quantity.min(), log_quantity.max(), bins + 1)
+    y_edges = np.linspace(price.min(), price.max(), bins + 1)
+    x_bin = np.clip(np.searchsorted(x_edges, log_quantity, side='right') - 1, 0, bins - 1)
+    y_bin = np.clip(np.searchsorted(y_edges, price, side='right') - 1, 0, bins - 1)
+
+    cell = x_bin * bins + y_bin
+    counts = np.bincount(cell, minlength=bins * bins)
+    occupied = np.flatnonzero(counts)
+    n = counts[occupied]
+    return pd.DataFrame({
+        'Количество': np.bincount(cell, weights=quantity, minlength=bins * bins)[occupied] / n,
+        'Цена': np.bincount(cell, weights=price, minlength=bins * bins)[occupied] / n,
+        'Сделок': n,
+        'Кол_от': 10 ** x_edges[occupied // bins],
+        'Кол_до': 10 ** x_edges[occupied // bins + 1],
+        'Цена_от': y_edges[occupied % bins],
+        'Цена_до': y_edges[occupied % bins + 1],
+    })
+
+
+def warehouse_selector(view, label="Выберите склад(ы)"):
+    # Shared `Склад` filter: pills inside an expander, nothing selected means all warehouses
+    with st.expander('Склад'):
+        selected_warehouses = st.pills(
+            label=label,
+            options=view.unique('Склад'),
+            selection_mode='multi',
+            default=None  # Start with no selections
+        )
+    return view.isin('Склад', selected_warehouses), selected_warehouses
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _cached_view_aggregate(digest, filters, by, metrics, _view):
+    # Keyed by the dataset digest and the view's filter tuple; the view itself is not hashed
+    return _view.aggregate(list(by), list(metrics))
+
+
+def time_selector(view):
     # Convert index to datetime if it's not already
-    if not isinstance(branch_df.index, pd.DatetimeIndex):
+    if not isinstance(view.base.index, pd.DatetimeIndex):
         st.error("DataFrame index is not a DatetimeIndex. Please ensure your index contains dates.")
-        return branch_df
+        return view
 
-    # Get min and max dates from index
-    min_date = branch_df.index.min().date()
-    max_date = branch_df.index.max().date()
+    # Get min and max dates of the view
+    min_date, max_date = (date.date() for date in view.date_bounds())
 
     # Create date input
     date_range = st.date_input(
@@ -306,14 +1788,239 @@ def time_selector(branch_df):
         start_ts = pd.Timestamp(start_date)
         end_ts = pd.Timestamp(end_date) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)  # End of day
 
-        # Filter dataframe
-        filtered_df = branch_df[(branch_df.index >= start_ts) & (branch_df.index <= end_ts)]
+        # Filter the view
+        filtered_view = view.between_dates(start_ts, end_ts)
 
         # Display selected range information
         st.write(f"Выбран период с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}")
-        st.write(f"Количество записей: {len(filtered_df)}")
+        st.write(f"Количество записей: {len(filtered_view)}")
 
-        return filtered_df
+        return filtered_view
     else:
         st.info("Пожалуйста, выберите конечную дату диапазона")
-        return branch_df
\ No newline at end of file
+        return view
+
+
+########## Price statistics
+# Below this many transactions medians are exact, above it they come from a histogram
+PRICE_MEDIAN_EXACT_ROWS = int(os.environ.get('DASHBOARD_PRICE_MEDIAN_EXACT_ROWS', 200_000))
+PRICE_MEDIAN_BINS = 2048
+
+
+def grouped_median(codes, n_groups, values, exact=True):
+    """
+    Median of `values` per group code (0..n_groups-1) and over all groups. Approximate
+    medians interpolate inside one histogram of PRICE_MEDIAN_BINS bins shared by the
+    groups, so their error stays below (max - min) / PRICE_MEDIAN_BINS.
+    """
+    keep = ~np.isnan(values)
+    codes, values = codes[keep], values[keep]
+    if not len(values):
+        return np.full(n_groups, np.nan), np.nan
+    if exact:
+        per_group = pd.Series(values).groupby(codes).median().reindex(range(n_groups)).to_numpy()
+        return per_group, float(np.median(values))
+
+    low = values.min()
+    width = (values.max() - low) / PRICE_MEDIAN_BINS or 1.0
+    bins = np.minimum(((values - low) / width).astype(np.int64), PRICE_MEDIAN_BINS - 1)
+    counts = np.bincount(codes * PRICE_MEDIAN_BINS + bins, minlength=n_groups * PRICE_MEDIAN_BINS)
+    counts = counts.reshape(n_groups, PRICE_MEDIAN_BINS)
+    # Last row is the histogram of all groups together
+    counts = np.vstack([counts, counts.sum(axis=0)])
+    cumulative = counts.cumsum(axis=1)
+    half = cumulative[:, -1] / 2
+    rows = np.arange(len(counts))
+    # First bin where the running count reaches half, then linear interpolation inside it
+    median_bin = np.minimum((cumulative < half[:, None]).sum(axis=1), PRICE_MEDIAN_BINS - 1)
+    before = np.where(median_bin > 0, cumulative[rows, median_bin - 1], 0)
+    inside = np.maximum(counts[rows, median_bin], 1)
+    medians = low + (median_bin + (half - before) / inside) * width
+    medians[cumulative[:, -1] == 0] = np.nan
+    return medians[:-1], float(medians[-1])
+
+
+class PriceStatistics:
+    """
+    Price statistics of a view per period, computed in one grouped aggregation.
+
+    `periods` has one row per period code (index named after `period_col`) with the
+    mean, median, min and max price, the number of priced transactions, revenue and
+    volume, plus list price mean and median when the dataset has 'Цена по прайсу'.
+    `overall` holds the same figures for the whole view together with the standard
+    deviation and the price/quantity correlation, all derived from the per-period sums.
+    """
+
+    def __init__(self, view, period_col, exact_median=None):
+        self.has_list_price = 'Цена по прайсу' in view.columns
+        columns = [period_col, 'Цена', 'Количество', 'Сумма'] + (['Цена по прайсу'] if self.has_list_price else [])
+        df = view.frame(columns)
+        self.exact_median = len(df) <= PRICE_MEDIAN_EXACT_ROWS if exact_median is None else exact_median
+
+        codes, periods = pd.factorize(df[period_col], sort=True)
+        # Rows without a period (NaT dates) are left out
+        df, codes = df[codes >= 0], codes[codes >= 0]
+        price = df['Цена'].to_numpy(dtype=float)
+        quantity = df['Количество'].to_numpy(dtype=float)
+
+        # Sums of squares are taken around one observed value of each column, so they
+        # do not lose precision when the spread is small next to the level
+        paired = ~np.isnan(price) & ~np.isnan(quantity)
+        price_shift = price[~np.isnan(price)][0] if (~np.isnan(price)).any() else 0.0
+        quantity_shift = quantity[paired][0] if paired.any() else 0.0
+        p = price - price_shift
+        pp = np.where(paired, p, np.nan)
+        qq = np.where(paired, quantity - quantity_shift, np.nan)
+        work = pd.DataFrame({
+            'p': p, 'p2': p ** 2, 'pp': pp, 'pp2': pp ** 2, 'qq': qq, 'qq2': qq ** 2, 'pq': pp * qq,
+            'Сумма': df['Сумма'].to_numpy(dtype=float), 'Количество': quantity,
+        })
+        aggregations = dict(
+            n=('p', 'count'), p_sum=('p', 'sum'), p2_sum=('p2', 'sum'), p_min=('p', 'min'), p_max=('p', 'max'),
+            n_pair=('pq', 'count'), pp_sum=('pp', 'sum'), pp2_sum=('pp2', 'sum'),
+            qq_sum=('qq', 'sum'), qq2_sum=('qq2', 'sum'), pq_sum=('pq', 'sum'),
+            revenue=('Сумма', 'sum'), volume=('Количество', 'sum'),
+        )
+        if self.has_list_price:
+            work['list'] = df['Цена по прайсу'].to_numpy(dtype=float)
+            aggregations.update(list_n=('list', 'count'), list_sum=('list', 'sum'))
+        sums = work.groupby(codes).agg(**aggregations).reindex(range(len(periods)))
+
+        medians, overall_median = grouped_median(codes, len(periods), price, self.exact_median)
+        self.periods = pd.DataFrame({
+            'Средняя_цена': price_shift + sums['p_sum'] / sums['n'],
+            'Медиана_цена': medians,
+            'Мин_цена': price_shift + sums['p_min'],
+            'Макс_цена': price_shift + sums['p_max'],
+            'Количество_транзакций': sums['n'],
+        })
+        if self.has_list_price:
+            list_medians, overall_list_median = grouped_median(codes, len(periods), work['list'].to_numpy(),
+                                                               self.exact_median)
+            self.periods['Средняя_цена_по_прайс_листу'] = sums['list_sum'] / sums['list_n']
+            self.periods['Медиана_цена_по_прайс_листу'] = list_medians
+        self.periods['Общий_доход'] = sums['revenue']
+        self.periods['Общее_количество'] = sums['volume']
+        self.periods.index = pd.Index(periods, name=period_col)
+
+        totals = sums.sum()
+        n, n_pair = totals['n'], totals['n_pair']
+        mean = price_shift + totals['p_sum'] / n if n else np.nan
+        variance = (totals['p2_sum'] - totals['p_sum'] ** 2 / n) / (n - 1) if n > 1 else np.nan
+        if n_pair > 1:
+            covariance = totals['pq_sum'] - totals['pp_sum'] * totals['qq_sum'] / n_pair
+            spread = ((totals['pp2_sum'] - totals['pp_sum'] ** 2 / n_pair) *
+                      (totals['qq2_sum'] - totals['qq_sum'] ** 2 / n_pair))
+            corr = covariance / np.sqrt(spread) if spread > 0 else np.nan
+        else:
+            corr = np.nan
+        self.overall = {
+            'count': int(n),
+            'mean': mean,
+            'median': overall_median,
+            'std': np.sqrt(max(variance, 0)) if n > 1 else np.nan,
+            'min': price_shift + sums['p_min'].min(),
+            'max': price_shift + sums['p_max'].max(),
+            'corr': corr,
+        }
+        if self.has_list_price:
+            self.overall['list_mean'] = totals['list_sum'] / totals['list_n'] if totals['list_n'] else np.nan
+            self.overall['list_median'] = overall_list_median
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _cached_price_statistics(digest, filters, period_col, exact_median, _view):
+    # Keyed like _cached_view_aggregate: the view's filters already hold the product,
+    # spec and date range, the view itself is not hashed
+    return PriceStatistics(_view, period_col, exact_median)
+
+
+def price_statistics(view, period_col, exact_median=None):
+    # PriceStatistics memoized per (dataset, filters, period)
+    if view.digest is None:
+        return PriceStatistics(view, period_col, exact_median)
+    return _cached_price_statistics(view.digest, view.filters, period_col, exact_median, view)
+
+
+########## Price/volume trend fits
+# Specs with fewer priced deals than this are left out of the volume-discount ranking
+TREND_MIN_DEALS = 10
+# Theil-Sen looks at every pair of points, so each group is subsampled to this many
+THEIL_SEN_MAX_POINTS = 300
+
+
+def _theil_sen(log_x, log_y, rng):
+    # Median of the pairwise slopes, intercept as the median residual
+    if len(log_x) > THEIL_SEN_MAX_POINTS:
+        pick = rng.choice(len(log_x), THEIL_SEN_MAX_POINTS, replace=False)
+        log_x, log_y = log_x[pick], log_y[pick]
+    dx = log_x[None, :] - log_x[:, None]
+    dy = log_y[None, :] - log_y[:, None]
+    upper = np.triu(np.ones(dx.shape, dtype=bool), k=1) & (dx != 0)
+    if not upper.any():
+        return np.nan, np.nan
+    slope = np.median(dy[upper] / dx[upper])
+    return slope, np.median(log_y - slope * log_x)
+
+
+def fit_price_trends(view, by='вид продукции', robust=False):
+    """
+    Power law price = a * quantity ** b fitted in log-log space for every group of `by`
+    at once. Least squares comes from per-group sums gathered with np.bincount; with
+    `robust` the slope is a Theil-Sen estimate instead. Returns one row per group with
+    the slope (b), intercept (log a), R² of the fit in log space and the number of deals.
+    """
+    df = view.frame([by, 'Количество', 'Цена'])
+    # Quantity 0 is read as 0.1 so those deals keep a finite logarithm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_x = np.log(df['Количество'].replace(0, 0.1).to_numpy(dtype=float))
+        log_y = np.log(df['Цена'].to_numpy(dtype=float))
+    keep = np.isfinite(log_x) & np.isfinite(log_y)
+    codes, groups = pd.factorize(df[by])
+    keep &= codes >= 0
+    codes, log_x, log_y = codes[keep], log_x[keep], log_y[keep]
+
+    def total(weights=None):
+        return np.bincount(codes, weights=weights, minlength=len(groups))
+
+    n = total()
+    sum_x, sum_y = total(log_x), total(log_y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Centered (co)variances from the raw sums
+        sxx = total(log_x ** 2) - sum_x ** 2 / n
+        syy = total(log_y ** 2) - sum_y ** 2 / n
+        sxy = total(log_x * log_y) - sum_x * sum_y / n
+        slope = np.where((n > 2) & (sxx > 0), sxy / sxx, np.nan)
+        intercept = (sum_y - slope * sum_x) / n
+        r2 = np.where(syy > 0, sxy ** 2 / (sxx * syy), np.nan)
+
+    if robust:
+        rng = np.random.default_rng(0)
+        order = np.argsort(codes, kind='stable')
+        starts = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+        for group in np.flatnonzero(n > 2):
+            rows = order[starts[group]:starts[group + 1]]
+            slope[group], intercept[group] = _theil_sen(log_x[rows], log_y[rows], rng)
+        # R² of the robust line against the same points
+        with np.errstate(divide='ignore', invalid='ignore'):
+            residual = total((log_y - intercept[codes] - slope[codes] * log_x) ** 2)
+            r2 = np.where(syy > 0, 1 - residual / syy, np.nan)
+
+    return pd.DataFrame({
+        'Наклон': slope,
+        'Пересечение': intercept,
+        'R2': r2,
+        'Сделок': n,
+    }, index=pd.Index(groups, name=by))
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _cached_price_trends(digest, filters, by, robust, _view):
+    return fit_price_trends(_view, by, robust)
+
+
+def price_trends(view, by='вид продукции', robust=False):
+    # fit_price_trends() memoized per (dataset, filters, grouping, estimator)
+    if view.digest is None:
+        return fit_price_trends(view, by, robust)
+    return _cached_price_trends(view.digest, view.filters, by, robust, view)
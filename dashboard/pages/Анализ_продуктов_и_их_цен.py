@@ -7,33 +7,29 @@ from datetime import datetime, timedelta
 
 from pygments.lexer import default
 
-from functions import time_selector
-if 'branch_df' in st.session_state:
-    # Retrieve the DataFrame
-    branch_df = st.session_state['branch_df']
-
-    # Now you can use the DataFrame
-    st.write(f"данные имеют {len(branch_df)} строк и {len(branch_df.columns)} столбцы")
+from functions import (time_selector, format_period_labels, bin_price_quantity, SCATTER_MAX_POINTS,
+                       format_numbers, format_dates, price_statistics, OUTLIER_STRATEGIES,
+                       price_trends, TREND_MIN_DEALS)
+if 'branch_view' in st.session_state:
+    # Retrieve the filtered view of the uploaded data
+    branch_view = st.session_state['branch_view']
+
+    # Now you can use the view
+    st.write(f"данные имеют {len(branch_view)} строк и {len(branch_view.columns)} столбцы")
 else:
     st.error("Данные не найдены в состоянии сеанса. Пожалуйста, перейдите на первую страницу, чтобы загрузить данные.")
+    st.stop()
 
 
 
 
-# 1. First check if the columns exist and that 'Сумма' & 'Количество' are numeric
-if 'Сумма' in branch_df.columns and 'Количество' in branch_df.columns:
-    branch_df = branch_df.dropna(subset=['Сумма', 'Количество'])
-    # Check for numeric type
-    if pd.api.types.is_numeric_dtype(branch_df['Сумма']) and pd.api.types.is_numeric_dtype(branch_df['Количество']):
-        # Replace zeros and NaNs with NaN to avoid division by zero
-        denominator = branch_df['Количество'].replace(0, np.nan)
-
-        # Calculate unit price only where denominator is valid
-        branch_df['Цена за единицу товара'] = branch_df['Сумма'] / denominator
+# 1. First check if the columns exist and drop rows without 'Сумма' & 'Количество'
+if 'Сумма' in branch_view.columns and 'Количество' in branch_view.columns:
+    branch_view = branch_view.notna(['Сумма', 'Количество'])
 
 
 # Date range filter
-branch_df=time_selector(branch_df)
+branch_view=time_selector(branch_view)
 
 
 
@@ -44,7 +40,7 @@ with tab1:
     st.header("Анализ концентрации продукта")
 
     # 1. Calculate product mix percentages
-    product_revenue = branch_df.groupby("продукция")['Сумма'].sum().reset_index()
+    product_revenue = branch_view.aggregate("продукция", 'Сумма').reset_index()
     total_revenue = product_revenue['Сумма'].sum()
     product_revenue['Процент'] = (product_revenue['Сумма'] / total_revenue * 100).round(2)
     product_revenue = product_revenue.sort_values('Сумма', ascending=False)
@@ -107,12 +103,13 @@ with tab1:
     top_product_types = product_revenue.head(top_k)["продукция"].tolist()
     # top_product_types = product_revenue.head(50)["продукция"].tolist()
     # Filter to just the top products
-    time_df = branch_df[branch_df["продукция"].isin(top_product_types)]
+    time_view = branch_view.isin("продукция", top_product_types)
     # Group by Период времени and Продукция
-    product_time_series = time_df.groupby([period_col, "продукция"])['Сумма'].sum().reset_index()
+    product_time_series = time_view.aggregate([period_col, "продукция"], 'Сумма').reset_index()
 
     # Create a pivot for easier plotting
     pivot_df = product_time_series.pivot(index=period_col, columns="продукция", values='Сумма').fillna(0)
+    pivot_df.index = format_period_labels(pivot_df.index, period_col)
     pivot_df['Всего'] = pivot_df.sum(axis=1)
 
     # Calculate percentages
@@ -174,16 +171,12 @@ with tab1:
     )
 
     # Filter data for the selected Продукция
-    spec_df = branch_df[branch_df["продукция"] == product_for_spec]
+    spec_view = branch_view.isin("продукция", [product_for_spec])
 
-    # Get top specifications by quantity and revenue
-    spec_analysis = spec_df.groupby("вид продукции").agg({
-        'Количество': 'sum',
-        'Сумма': 'sum',
-        'product': 'count'  # Count of transactions
-    }).reset_index()
+    # Get top specifications by quantity, revenue and count of transactions
+    spec_analysis = spec_view.aggregate("вид продукции", ['Количество', 'Сумма', 'Count']).reset_index()
 
-    spec_analysis.rename(columns={'product': 'Количество_транзакций'}, inplace=True)
+    spec_analysis.rename(columns={'Count': 'Количество_транзакций'}, inplace=True)
 
     # Sort by different metrics
     sort_by = st.radio("Сортировать по", ["Доход", 'Количество', 'Количество_транзакций'], horizontal=True)
@@ -229,12 +222,19 @@ with tab2:
         options=product_revenue.head(50)["продукция"].tolist(),
         key="price_product"
     )
+    # Outlier bounds per product and spec are computed once when the dataset is loaded
+    outlier_strategy = st.selectbox(
+        "Фильтр выбросов цены",
+        options=list(OUTLIER_STRATEGIES),
+        format_func=lambda x: OUTLIER_STRATEGIES[x],
+        key="price_outliers"
+    )
     # Filter data for selected product
-    price_df = branch_df[branch_df["продукция"] == price_product].copy()
+    price_view = branch_view.isin("продукция", [price_product])
     #clear outliers
-    price_df = price_df[price_df['Цена'] <= 6 * price_df['Цена'].mean()]
+    price_view = price_view.without_price_outliers(outlier_strategy)
 
-    product_specs = price_df["вид продукции"].unique().tolist()
+    product_specs = price_view.unique("вид продукции")
     # Handle case when no specs are available
     if not product_specs:
         st.warning(f"Тип продукта не найден")
@@ -250,7 +250,9 @@ with tab2:
         key="price_product_spec"
     )
     # Filter data for the selected specification
-    price_df = price_df[price_df["вид продукции"] == price_product_spec].copy()
+    product_view = price_view
+    price_view = price_view.isin("вид продукции", [price_product_spec])
+    price_df = price_view.frame()
     product_title = f"{price_product} ({price_product_spec})"
     st.info(f"показываю тенденции цен для {price_product} со спецификацией: {price_product_spec}")
 
@@ -271,41 +273,24 @@ with tab2:
             period_col = 'ГодЧетверть'
         else:
             period_col = 'Год'
-        # Check if "Цена по прайсу" column exists in the data
-        has_list_price = 'Цена по прайсу' in price_df.columns
-
-        # Calculate price statistics for each period, including list price if available
-        if has_list_price:
-            price_stats = price_df.groupby(period_col).agg({
-                'Цена': ['mean', 'median', 'min', 'max', 'count'],
-                'Цена по прайсу': ['mean', 'median'],  # Add list price statistics
-                'Сумма': 'sum',
-                'Количество': 'sum'
-            })
-
-            price_stats.columns = ['Средняя_цена', 'Медиана_цена', 'Мин_цена', 'Макс_цена',
-                                   'Количество_транзакций', 'Средняя_цена_по_прайс_листу', 'Медиана_цена_по_прайс_листу',
-                                   'Общий_доход', 'Общее_количество']
-        else:
-            price_stats = price_df.groupby(period_col).agg({
-                'Цена': ['mean', 'median', 'min', 'max', 'count'],
-                'Сумма': 'sum',
-                'Количество': 'sum'
-            })
-
-            price_stats.columns = ['Средняя_цена', 'Медиана_цена', 'Мин_цена', 'Макс_цена',
-                                   'Количество_транзакций', 'Общий_доход', 'Общее_количество']
-
-        price_stats = price_stats.reset_index()
+        # All price statistics of the tab, per period and overall (including list price if
+        # available), come from one grouped pass cached per product, spec, period and dates
+        price_summary = price_statistics(price_view, period_col)
+        has_list_price = price_summary.has_list_price
+        if not price_summary.exact_median:
+            st.caption("Медианы рассчитаны приближенно по гистограмме цен.")
+
+        price_stats = price_summary.periods.reset_index()
+        price_stats[period_col] = format_period_labels(price_stats[period_col], period_col)
         st.dataframe(price_df)
         # Calculate overall average for reference
-        overall_avg = price_df['Цена'].mean()
+        overall_avg = price_summary.overall['mean']
         # Add descriptive statistics about the price
         stats_col1, stats_col2, stats_col3 = st.columns(3)
         with stats_col1:
             st.metric("Средняя цена", f"{overall_avg:.2f}")
         with stats_col2:
-            price_std = price_df['Цена'].std()
+            price_std = price_summary.overall['std']
             st.metric("Стандартное отклонение", f"{price_std:.2f}")
         with stats_col3:
             cv = (price_std / overall_avg * 100) if overall_avg > 0 else 0
@@ -349,7 +334,7 @@ with tab2:
 
             if show_list_price:
                 # Calculate overall average list price for reference
-                overall_list_avg = price_df['Цена по прайсу'].mean()
+                overall_list_avg = price_summary.overall['list_mean']
 
                 # Add dropdown to select which list price metric to show
                 list_price_metric = st.radio(
@@ -486,7 +471,7 @@ with tab2:
             )
 
             # Add vertical line for median
-            median_price = price_df['Цена'].median()
+            median_price = price_summary.overall['median']
             dist_fig.add_vline(
                 x=median_price,
                 line_dash="dash",
@@ -501,52 +486,88 @@ with tab2:
         # Add filters to narrow down data if needed
         show_transaction_scatter = st.checkbox("Показать график сделок (цена/количество)", value=True)
         if show_transaction_scatter:
+            # Zoom into a region of the chart: once few enough deals are left in it,
+            # they are drawn one by one instead of binned
+            scatter_df = price_df
+            with st.expander("Область графика"):
+                for column, label in [('Количество', "Объем (кг)"), ('Цена', "Цена за единицу (₸)")]:
+                    low, high = float(price_df[column].min()), float(price_df[column].max())
+                    if low < high:
+                        low, high = st.slider(label, low, high, (low, high), key=f"scatter_{column}")
+                        scatter_df = scatter_df[scatter_df[column].between(low, high)]
+
             # Create scatter plot
             fig = go.Figure()
 
-            # Add scatter plot with Unit_Price vs Quantity
-            fig.add_trace(go.Scatter(
-                x=price_df['Количество'],  # X-axis is now quantity
-                y=price_df['Цена'],  # Y-axis is now unit price
-                mode='markers',
-                marker=dict(
-                    size=10,  # Fixed size for better readability
-                    color='royalblue',
-                    opacity=0.7,
-                    line=dict(width=1, color='darkblue')
-                ),
-                text=price_df.apply(
-                    lambda row: f"Дата: {row.name.strftime('%d.%m.%Y')}<br>" +
-                                f"Цена: {row['Цена']:.2f} ₸<br>" +
-                                f"Сумма: {row['Сумма']:,.0f} ₸<br>" +
-                                f"Количество: {row['Количество']:,.1f} кг",
-                    axis=1
-                ),
-                hoverinfo='text'
-            ))
+            if len(scatter_df) > SCATTER_MAX_POINTS:
+                # Too many deals to ship to the browser: one marker per occupied cell of a
+                # log-quantity x price grid, sized and colored by the number of deals in it
+                density = bin_price_quantity(scatter_df['Количество'], scatter_df['Цена'])
+                fig.add_trace(go.Scatter(
+                    x=density['Количество'],
+                    y=density['Цена'],
+                    mode='markers',
+                    marker=dict(
+                        symbol='square',
+                        size=6 + 18 * np.sqrt(density['Сделок'] / density['Сделок'].max()),
+                        color=np.log10(density['Сделок']),
+                        colorscale='Blues',
+                        cmin=0,
+                        colorbar=dict(title="Сделок (log10)"),
+                        line=dict(width=1, color='darkblue')
+                    ),
+                    text="Сделок: " + format_numbers(density['Сделок']) +
+                         "<br>Количество: " + format_numbers(density['Кол_от'], 1) +
+                         " – " + format_numbers(density['Кол_до'], 1, 'кг') +
+                         "<br>Цена: " + format_numbers(density['Цена_от'], 2, separator='') +
+                         " – " + format_numbers(density['Цена_до'], 2, '₸', separator=''),
+                    hoverinfo='text',
+                    showlegend=False
+                ))
+                st.caption(f"{len(scatter_df):,} сделок сгруппированы в {len(density):,} ячеек. "
+                           f"Сузьте область графика до {SCATTER_MAX_POINTS:,} сделок, чтобы увидеть каждую сделку.")
+            else:
+                # Add scatter plot with Unit_Price vs Quantity
+                fig.add_trace(go.Scatter(
+                    x=scatter_df['Количество'],  # X-axis is now quantity
+                    y=scatter_df['Цена'],  # Y-axis is now unit price
+                    mode='markers',
+                    marker=dict(
+                        size=10,  # Fixed size for better readability
+                        color='royalblue',
+                        opacity=0.7,
+                        line=dict(width=1, color='darkblue')
+                    ),
+                    # Hover text is built column by column, not row by row
+                    text="Дата: " + format_dates(scatter_df.index) +
+                         "<br>Цена: " + format_numbers(scatter_df['Цена'], 2, '₸', separator='') +
+                         "<br>Сумма: " + format_numbers(scatter_df['Сумма'], 0, '₸') +
+                         "<br>Количество: " + format_numbers(scatter_df['Количество'], 1, 'кг'),
+                    hoverinfo='text'
+                ))
 
             # Calculate average price
-            avg_price = price_df['Цена'].mean()
-            median_price = price_df['Цена'].median()
+            avg_price = price_summary.overall['mean']
+            median_price = price_summary.overall['median']
 
             # Add reference lines for average and median price
             fig.add_shape(
                 type="line",
-                x0=price_df['Количество'].min(), x1=price_df['Количество'].max(),
+                x0=scatter_df['Количество'].min(), x1=scatter_df['Количество'].max(),
                 y0=avg_price, y1=avg_price,
                 line=dict(color="red", width=2, dash="dash"),
             )
 
             fig.add_shape(
                 type="line",
-                x0=price_df['Количество'].min(), x1=price_df['Количество'].max(),
+                x0=scatter_df['Количество'].min(), x1=scatter_df['Количество'].max(),
                 y0=median_price, y1=median_price,
                 line=dict(color="green", width=2, dash="dash"),
             )
 
             # Add annotations for the lines
             fig.add_annotation(
-                x=price_df['Количество'].max(),
+                x=scatter_df['Количество'].max(),
                 y=avg_price,
                 text=f"Средняя цена: {avg_price:.2f} ₸",
                 showarrow=True,
@@ -557,7 +578,7 @@ with tab2:
             )
 
             fig.add_annotation(
-                x=price_df['Количество'].max(),
+                x=scatter_df['Количество'].max(),
                 y=median_price,
                 text=f"Медианная цена: {median_price:.2f} ₸",
                 showarrow=True,
@@ -567,47 +588,41 @@ with tab2:
                 font=dict(color="green")
             )
 
-            # Add trend line (power law: y = ax^b often fits price-quantity relationships)
-            if len(price_df) > 2:
-                try:
-                    # Take logs for power law regression (log y = log a + b log x)
-                    log_x = np.log(price_df['Количество'].replace(0, 0.1))  # Avoid log(0)
-                    log_y = np.log(price_df['Цена'])
-                    mask = np.isfinite(log_x) & np.isfinite(log_y)
-
-                    if sum(mask) > 2:  # Need at least 3 valid points
-                        from scipy import stats
-
-                        slope, intercept, r_value, p_value, std_err = stats.linregress(
-                            log_x[mask], log_y[mask]
-                        )
-
-                        # Add power law curve
-                        x_range = np.linspace(
-                            max(0.1, price_df['Количество'].min()),
-                            price_df['Количество'].max(),
-                            100
-                        )
-                        y_range = np.exp(intercept) * x_range ** slope
-
-                        fig.add_trace(go.Scatter(
-                            x=x_range, y=y_range,
-                            mode='lines',
-                            line=dict(color='black', width=2),
-                            name=f'Trend (R²: {r_value ** 2:.2f})'
-                        ))
-
-                        # Add trend description
-                        if slope < -0.05:
-                            trend_desc = f"Обнаружена отрицательная зависимость: при увеличении объема цена снижается (скидка за объем)"
-                        elif slope > 0.05:
-                            trend_desc = f"Обнаружена положительная зависимость: при увеличении объема цена растет"
-                        else:
-                            trend_desc = f"Зависимость цены от объема практически отсутствует"
-
-                        st.info(trend_desc)
-                except Exception as e:
-                    st.warning(f"Не удалось рассчитать линию тренда: {e}")
+            # Add trend line (power law: y = ax^b often fits price-quantity relationships).
+            # Every spec of the product is fitted in one batch, cached, so toggling the axis
+            # scale or other options only looks the coefficients up
+            robust_trend = st.checkbox("Робастный тренд (Тейл–Сен)", value=False)
+            trends = price_trends(product_view, robust=robust_trend)
+            trend = trends.loc[price_product_spec] if price_product_spec in trends.index else None
+            if trend is not None and trend['Сделок'] > 2 and np.isfinite(trend['Наклон']):
+                slope, intercept = trend['Наклон'], trend['Пересечение']
+
+                # Add power law curve
+                x_range = np.linspace(
+                    max(0.1, price_df['Количество'].min()),
+                    price_df['Количество'].max(),
+                    100
+                )
+                y_range = np.exp(intercept) * x_range ** slope
+
+                fig.add_trace(go.Scatter(
+                    x=x_range, y=y_range,
+                    mode='lines',
+                    line=dict(color='black', width=2),
+                    name=f'Trend (R²: {trend["R2"]:.2f})'
+                ))
+
+                # Add trend description
+                if slope < -0.05:
+                    trend_desc = f"Обнаружена отрицательная зависимость: при увеличении объема цена снижается (скидка за объем)"
+                elif slope > 0.05:
+                    trend_desc = f"Обнаружена положительная зависимость: при увеличении объема цена растет"
+                else:
+                    trend_desc = f"Зависимость цены от объема практически отсутствует"
+
+                st.info(trend_desc)
+            else:
+                st.warning("Недостаточно данных для расчета линии тренда")
 
             # Update layout
             fig.update_layout(
@@ -628,7 +643,7 @@ with tab2:
             st.plotly_chart(fig, use_container_width=True)
 
             # Add correlation info
-            corr = price_df['Цена'].corr(price_df['Количество'])
+            corr = price_summary.overall['corr']
             st.metric("Корреляция цена-количество", f"{corr:.2f}")
 
             # Additional explanation
@@ -636,8 +651,22 @@ with tab2:
             На данном графике:
             - Ось X: Объем продаж в кг
             - Ось Y: Цена за единицу (₸)
-            - Каждая точка представляет отдельную сделку
+            - Каждая точка представляет отдельную сделку (или ячейку со сделками, если их слишком много)
             - Красная линия: средняя цена за единицу
             - Зеленая линия: медианная цена за единицу
             - Черная линия: тренд зависимости цены от объема
-            """)
\ No newline at end of file
+            """)
+
+            # Specs of the product ranked by volume discount, from the same batch of fits
+            with st.expander("Виды продукции с наибольшей скидкой за объем"):
+                discounts = trends[(trends['Сделок'] >= TREND_MIN_DEALS) & (trends['Наклон'] < 0)]
+                st.dataframe(
+                    discounts.sort_values('Наклон').head(20),
+                    column_config={
+                        "Наклон": st.column_config.NumberColumn(
+                            "Эластичность цены", help="Изменение цены в % при росте объема на 1%", format="%.3f"),
+                        "Пересечение": None,
+                        "R2": st.column_config.NumberColumn("R²", format="%.2f"),
+                        "Сделок": st.column_config.NumberColumn("Сделок", format="%d"),
+                    }
+                )
\ No newline at end of file
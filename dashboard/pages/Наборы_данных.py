@@ -0,0 +1,36 @@
+import pandas as pd
+import streamlit as st
+
+from functions import dataset_registry, DATASET_IDLE_SECONDS
+
+st.header("Наборы данных в памяти сервера")
+st.caption(f"Наборы без активных сессий выгружаются после {DATASET_IDLE_SECONDS // 60} мин. простоя")
+
+registry = dataset_registry()
+# Drop closed sessions and idle datasets before showing the current state
+registry.evict_idle()
+stats = pd.DataFrame(registry.stats())
+
+if stats.empty:
+    st.info("Сейчас в памяти нет загруженных наборов данных.")
+else:
+    col1, col2 = st.columns(2)
+    col1.metric("Наборов данных", len(stats))
+    col2.metric("Память", f"{stats['memory_mb'].sum():,.0f} MB")
+    st.dataframe(
+        stats,
+        column_config={
+            "digest": "Хеш",
+            "name": "Файл",
+            "rows": st.column_config.NumberColumn("Строк", format="%d"),
+            "columns": "Столбцов",
+            "memory_mb": st.column_config.NumberColumn("Память", format="%.1f MB"),
+            "sessions": "Сессий",
+            "idle_minutes": st.column_config.NumberColumn("Простой", format="%.0f мин"),
+        },
+        hide_index=True,
+    )
+
+if st.button("Выгрузить неиспользуемые наборы сейчас"):
+    registry.evict_idle(idle_seconds=0)
+    st.rerun()
@@ -2,84 +2,34 @@ from operator import truediv
 import pandas as pd
 import streamlit as st
 from datetime import datetime, timedelta
-from панель_продаж import optimize_dataframe
+from functions import time_selector, warehouse_selector, bar3d_traces, format_numbers, truncate_labels
 import pydeck as pdk
 import numpy as np
 import plotly.graph_objects as go
 
 
-if 'branch_df' in st.session_state:
-    # Retrieve the DataFrame
-    branch_df = st.session_state['branch_df']
+if 'branch_view' in st.session_state:
+    # Retrieve the filtered view of the uploaded data
+    branch_view = st.session_state['branch_view']
 
-    # Now you can use the DataFrame
-    st.write(f"данные имеют {len(branch_df)} строк и {len(branch_df.columns)} столбцы")
+    # Now you can use the view
+    st.write(f"данные имеют {len(branch_view)} строк и {len(branch_view.columns)} столбцы")
 else:
     st.error("Данные не найдены в состоянии сеанса. Пожалуйста, перейдите на первую страницу, чтобы загрузить данные.")
+    st.stop()
 
 
 ################# Calculate cutoff date if you wish to limit the data
 
 ###################### Add st.pills for selecting values in the 'Склад' column######################################
-warehouse_options = list(branch_df['Склад'].unique())
-with st.expander('Склад'):
-    selected_warehouses = st.pills(
-        label="Выберите склад(ы)",
-        options=warehouse_options,
-        selection_mode='multi',
-        default=None  # Start with no selections
-    )
-@st.cache_data
-def select_warehouse(branch_df):
-    # Filter the DataFrame based on selected warehouses
-    if selected_warehouses:
-        branch_df = branch_df[branch_df['Склад'].astype(str).isin(selected_warehouses)]
-        return branch_df
-    else:
-        return branch_df
-branch_df=select_warehouse(branch_df)
+# Filter the view based on selected warehouses (no filtering if none are selected)
+branch_view, selected_warehouses = warehouse_selector(branch_view)
 
 #######################("3D Product Analysis")
 st.header("3D-анализ продукции за определенный период времени")
 
 # Time range selector
-def time_selector(branch_df):
-    # Convert index to datetime if it's not already
-    if not isinstance(branch_df.index, pd.DatetimeIndex):
-        st.error("DataFrame index is not a DatetimeIndex. Please ensure your index contains dates.")
-        return branch_df
-
-    # Get min and max dates from index
-    min_date = branch_df.index.min().date()
-    max_date = branch_df.index.max().date()
-
-    # Create date input
-    date_range = st.date_input(
-        "Выберите временной диапазон",
-        value=[min_date, max_date],
-        min_value=min_date,
-        max_value=max_date
-    )
-
-    # Check if user has selected a range (two dates)
-    if len(date_range) == 2:
-        start_date, end_date = date_range
-        # Convert to Timestamp for proper comparison with DatetimeIndex
-        start_ts = pd.Timestamp(start_date)
-        end_ts = pd.Timestamp(end_date) + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)  # End of day
-
-        # Filter dataframe
-        filtered_df = branch_df[(branch_df.index >= start_ts) & (branch_df.index <= end_ts)]
-
-        # Display selected range information
-        st.write(f"Выбран период с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}")
-        st.write(f"Количество записей: {len(filtered_df)}")
-
-        return filtered_df
-    else:
-        st.info("Пожалуйста, выберите конечную дату диапазона")
-        return branch_df
-branch_df=time_selector(branch_df)
+branch_view=time_selector(branch_view)
 
 
 # Metric selection
@@ -96,20 +46,17 @@ selected_metric = st.selectbox(
 )
 
 # Product type selection
-all_product_types = branch_df["продукция"].unique().tolist()
+all_product_types = branch_view.unique("продукция")
 product_type_options = ["Вся продукция"] + all_product_types
 selected_product_type = st.selectbox("Выберите продукцию", product_type_options)
 
 # Determine if we're showing product types or specifications
 if selected_product_type != "Вся продукция":
     # Filter for the selected product type
-    filtered_df = branch_df[branch_df["продукция"] == selected_product_type]
+    filtered_view = branch_view.isin("продукция", [selected_product_type])
 
     # Group by product_spec
-    if selected_metric == 'Count':
-        grouped_data = filtered_df.groupby("вид продукции").size().reset_index(name=selected_metric)
-    else:
-        grouped_data = filtered_df.groupby("вид продукции")[selected_metric].sum().reset_index()
+    grouped_data = filtered_view.aggregate("вид продукции", selected_metric).reset_index()
 
     # Rename columns for clarity
     grouped_data.rename(columns={'вид продукции': 'категория'}, inplace=True)
@@ -117,10 +64,7 @@ if selected_product_type != "Вся продукция":
     title = f"Лучший тип продукта {selected_product_type} по {metric_options[selected_metric]}"
 else:
     # Group by product_type
-    if selected_metric == 'Count':
-        grouped_data = branch_df.groupby("продукция").size().reset_index(name=selected_metric)
-    else:
-        grouped_data = branch_df.groupby("продукция")[selected_metric].sum().reset_index()
+    grouped_data = branch_view.aggregate("продукция", selected_metric).reset_index()
 
     # Rename columns for clarity
     grouped_data.rename(columns={"продукция": 'категория'}, inplace=True)
@@ -160,11 +104,9 @@ else:
 
 
 
-# Create 3D bars using separate traces for each bar
+# Create 3D bars: all bars go into one mesh, one outline trace and one label trace
 fig = go.Figure()
-# Calculate grid positions for the bars
 num_items = len(grouped_data)
-grid_size = int(np.ceil(np.sqrt(num_items)))
 # Colors for the bars (using a blue color scale)
 qualitative_colors = [
     'rgb(166,206,227)', 'rgb(31,120,180)', 'rgb(178,223,138)',
@@ -175,78 +117,16 @@ qualitative_colors = [
 # Repeat the colors if we have more bars than colors
 bar_colors = [qualitative_colors[i % len(qualitative_colors)] for i in range(num_items)]
 
-# Keep track of category positions
-category_positions = {}
-
-# Add bars one by one
-for index, (idx, row) in enumerate(grouped_data.iterrows()):
-    x_pos = index % grid_size
-    y_pos = index // grid_size
-    category_positions[row['категория']] = (x_pos, y_pos)
-
-    # Format hover text
-    if selected_metric == 'Сумма':
-        formatted_value = f"{row[selected_metric]:,.0f} ₸"
-    else:
-        formatted_value = f"{row[selected_metric]:,.0f}"
-
-    hover_text = f"{row['категория']}<br>{metric_options[selected_metric]}: {formatted_value}"
-
-    # Use a fixed color for all bars or vary by index
-    bar_color = bar_colors[index % len(bar_colors)]  # Use the bar's index, not i
-
-    # Add a simple box trace
-    fig.add_trace(go.Scatter3d(
-        x=[x_pos, x_pos + 0.7, x_pos + 0.7, x_pos, x_pos],
-        y=[y_pos, y_pos, y_pos + 0.7, y_pos + 0.7, y_pos],
-        z=[row[selected_metric], row[selected_metric], row[selected_metric], row[selected_metric],
-           row[selected_metric]],
-        mode='lines',
-        line=dict(color=bar_color, width=6),
-        surfaceaxis=2,  # This tells it to fill the z-axis surface
-        text=hover_text,
-        hoverinfo='text',
-        showlegend=False
-    ))
-
-    # Bottom of the box
-    fig.add_trace(go.Scatter3d(
-        x=[x_pos, x_pos + 0.7, x_pos + 0.7, x_pos, x_pos],
-        y=[y_pos, y_pos, y_pos + 0.7, y_pos + 0.7, y_pos],
-        z=[0, 0, 0, 0, 0],
-        mode='lines',
-        line=dict(color=bar_color, width=6),
-        surfaceaxis=2,  # This tells it to fill the z-axis surface
-        showlegend=False
-    ))
-
-    # Connect top to bottom with lines at the corners
-    for corner_x, corner_y in [(x_pos, y_pos), (x_pos + 0.7, y_pos), (x_pos + 0.7, y_pos + 0.7), (x_pos, y_pos + 0.7)]:
-        fig.add_trace(go.Scatter3d(
-            x=[corner_x, corner_x],
-            y=[corner_y, corner_y],
-            z=[0, row[selected_metric]],
-            mode='lines',
-            line=dict(color=bar_color, width=6),
-            showlegend=False
-        ))
-
-    # Add text label on top of the bar
-    fig.add_trace(go.Scatter3d(
-        x=[x_pos + 0.35],
-        y=[y_pos + 0.35],
-        z=[row[selected_metric] * 1.05],  # Slightly above the bar
-        mode='text',
-        text=[row['категория'][:10] + '...' if len(row['категория']) > 10 else row['категория']],
-        textposition='top center',
-        textfont=dict(
-            size=16,  # Increase font size (default is 12)
-            family="Times New Roman Bold"  # Use a bold font family
-            # color=white  # Ensure good contrast
-        ),
-        showlegend=False,
+categories = grouped_data['категория'].astype(str)
+values = grouped_data[selected_metric].to_numpy()
+
+# Format hover text
+unit = "₸" if selected_metric == 'Сумма' else ""
+hover_text = categories + f"<br>{metric_options[selected_metric]}: " + format_numbers(grouped_data[selected_metric], 0, unit)
+labels = truncate_labels(categories)
 
-    ))
+bar_traces, grid_size = bar3d_traces(values, labels, hover_text, bar_colors)
+fig.add_traces(bar_traces)
 
 
 # Update layout with conditional axis formatting based on selected metric
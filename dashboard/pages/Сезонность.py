@@ -2,69 +2,56 @@ from operator import truediv
 import pandas as pd
 import streamlit as st
 from datetime import datetime, timedelta
-from панель_продаж import optimize_dataframe
+from functions import format_period_labels, warehouse_selector
 
-# Check if the DataFrame exists in session state
-if 'branch_df' in st.session_state:
-    # Retrieve the DataFrame
-    branch_df = st.session_state['branch_df']
+# Check if the data view exists in session state
+if 'branch_view' in st.session_state:
+    # Retrieve the filtered view of the uploaded data
+    branch_view = st.session_state['branch_view']
 
-    # Now you can use the DataFrame
-    st.write(f"данные имеют {len(branch_df)} строк и {len(branch_df.columns)} столбцы")
+    # Now you can use the view
+    st.write(f"данные имеют {len(branch_view)} строк и {len(branch_view.columns)} столбцы")
 else:
     st.error("Данные не найдены в состоянии сеанса. Пожалуйста, перейдите на первую страницу, чтобы загрузить данные.")
+    st.stop()
 
 
 
 ################# Calculate cutoff date if you wish to limit the data
 
 
-st.info(f"Анализ данных c {branch_df.index.min().strftime('%b %Y')} по {branch_df.index.max().strftime('%b %Y')}")
+first_date, last_date = branch_view.date_bounds()
+st.info(f"Анализ данных c {first_date.strftime('%b %Y')} по {last_date.strftime('%b %Y')}")
 
 
 
 
 #############separate into type and spec
-type_options=['Все']+list(branch_df["продукция"].unique())
+type_options=['Все']+branch_view.unique("продукция")
 selected_types = st.multiselect("Выберите продукцию", type_options)
-if "Все" in selected_types or not selected_types:
-    branch_df = branch_df  # If "All" is selected or nothing is selected, show all specs
-else:
-    branch_df = branch_df[branch_df["продукция"].isin(selected_types)]
+if "Все" not in selected_types:
+    # Nothing selected leaves the view unfiltered
+    branch_view = branch_view.isin("продукция", selected_types)
 
 # Add "All" option for product spec selection
-spec_options = ["Все"] + list(branch_df["вид продукции"].unique())
+spec_options = ["Все"] + branch_view.unique("вид продукции")
 selected_specs = st.multiselect("Выберите вид продукции", spec_options)
 # Apply filtering logic for product specs
-if "Все" in selected_specs or not selected_specs:
-    branch_df = branch_df  # If "All" is selected or nothing is selected, show all specs
-else:
-    branch_df = branch_df[branch_df["вид продукции"].isin(selected_specs)]
+if "Все" not in selected_specs:
+    branch_view = branch_view.isin("вид продукции", selected_specs)
 
 
 
 
 ###################### Add st.pills for selecting values in the 'Склад' column
-warehouse_options = list(branch_df['Склад'].unique())
-with st.expander('Склад'):
-    selected_warehouses = st.pills(
-        label="Выберите Склад",
-        options=warehouse_options,
-        selection_mode='multi',
-        default=None  # Start with no selections
-    )
-
-# Filter the DataFrame based on selected warehouses
-if selected_warehouses:
-    branch_df = branch_df[branch_df['Склад'].astype(str).isin(selected_warehouses)]
-else:
-    branch_df = branch_df  # No filtering if no warehouses are selected
+# Filter the view based on selected warehouses (no filtering if none are selected)
+branch_view, selected_warehouses = warehouse_selector(branch_view, label="Выберите Склад")
 
 
 
 ########display the data to be able to see
 st.data_editor(
-    branch_df,
+    branch_view.frame(),
     column_config={"Сумма":st.column_config.NumberColumn(
             "Сумма", help="The deal value in KZT", format="₸ %.2f"),
         "Количество": st.column_config.NumberColumn(
@@ -87,82 +74,29 @@ selected_metric = st.selectbox(
     format_func=lambda x: metric_options[x]  # Display the friendly name in the dropdown
 )
 
-# Add units to the label
-# 1. Monthly Analysis
-if selected_metric == 'Count':
-    monthly_data = branch_df.groupby('ГодМесяц').agg({
-        'product': 'count'  # Count the number of transactions
-    })
-else:
-    # For 'Сумма' or 'Количество', sum the values
-    monthly_data = branch_df.groupby('ГодМесяц').agg({
-        selected_metric: 'sum'
-    })
-
-# 2. Quarterly Analysis
-if selected_metric == 'Count':
-    quarterly_data = branch_df.groupby('ГодЧетверть').agg({
-        'product': 'count'  # Count the number of transactions
-    })
-else:
-    # For 'Сумма' or 'Количество', sum the values
-    quarterly_data = branch_df.groupby('ГодЧетверть').agg({
-        selected_metric: 'sum'
-    })
-
-# 3. Yearly Analysis
-if selected_metric == 'Count':
-    yearly_data = branch_df.groupby('Год').agg({
-        'product': 'count'  # Count the number of transactions
-    })
-else:
-    # For 'Сумма' or 'Количество', sum the values
-    yearly_data = branch_df.groupby('Год').agg({
-        selected_metric: 'sum'
-    })
-
 ############################### Visualizations TIME SERIES BARS#######################################
 # Create a branch title for the header
 time_period = st.radio("Select Time Period", ['Ежемесячно', 'Ежеквартально', 'Ежегодно'])
 
-# Select the data and x-axis column based on the time period
-if time_period == 'Ежемесячно':
-    data = monthly_data
-    x_col = monthly_data.index
-    x_title = 'Месяц'
-    # filter for the time
-    start_date, end_date = st.select_slider(
-        "Выберите временной диапазон",options=list(data.index),
-        value=(data.index.min(), data.index.max())
-    )
-    st.write("Вы выбрали данные между", start_date, "и", end_date)
-    data = data[(data.index >= start_date) & (data.index <= end_date)]
-
-elif time_period == 'Ежеквартально':
-    data = quarterly_data
-    x_col = quarterly_data.index
-    x_title = 'Четверть'
-    # filter for the time
-    start_date, end_date = st.select_slider(
-        "Выберите временной диапазон", options=list(data.index),
-        value=(data.index.min(), data.index.max())
-    )
-    st.write("Вы выбрали данные между", start_date, "и", end_date)
-    data = data[(data.index >= start_date) & (data.index <= end_date)]
-else:  # Yearly
-    data = yearly_data
-    x_col = yearly_data.index
-    x_title = 'Год'
-    # filter for the time
-    start_date, end_date = st.select_slider(
-        "Выберите временной диапазон", options=list(data.index),
-        value=(data.index.min(), data.index.max())
-    )
-    st.write("Вы выбрали данные между", start_date, "и", end_date)
-    data = data[(data.index >= start_date) & (data.index <= end_date)]
+# Only the selected period is aggregated. Results are memoized per dataset, filters,
+# metric and period, so the slider and radio buttons re-slice a cached series.
+period_col = {'Ежемесячно': 'ГодМесяц', 'Ежеквартально': 'ГодЧетверть', 'Ежегодно': 'Год'}[time_period]
+period_data = branch_view.cached_aggregate(period_col, selected_metric)
+
+# filter for the time
+start_date, end_date = st.select_slider(
+    "Выберите временной диапазон", options=list(period_data.index),
+    value=(period_data.index.min(), period_data.index.max()),
+    format_func=lambda code: format_period_labels([code], period_col)[0]
+)
+st.write("Вы выбрали данные между", " и ".join(format_period_labels([start_date, end_date], period_col)))
+# The period index is sorted, so the range is a slice
+data = period_data.loc[start_date:end_date].copy()
 
 #add growth rate
 data['Growth Rate']=data.pct_change()
+# Integer period keys are turned into labels only for display
+data.index = format_period_labels(data.index, period_col)
 
 
 # Add a checkbox to toggle the growth rate line
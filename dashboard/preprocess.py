@@ -0,0 +1,113 @@
+"""
+Preprocess a directory of raw branch exports (1C Excel/CSV dumps) into the Parquet
+dataset the dashboard opens directly, partitioned by year and branch. Files are
+processed in parallel worker processes, and the branch of each is its file name
+without the suffix. A manifest in the output directory records the processed files,
+so a rerun only processes new or changed files and drops the data of removed ones.
+
+Run from the dashboard directory, e.g.:
+    python preprocess.py /data/raw /data/prepared --jobs 4
+and start the dashboard with DASHBOARD_PREPARED_DIR=/data/prepared.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from functions import (PREPARED_MANIFEST, RAW_EXPORT_SUFFIXES, file_digest, prepared_files, preprocess_export,
+                       read_raw_export, write_prepared_partitions)
+
+
+def process_file(path, output):
+    # Runs in a worker process: all stages for one export, written straight into the dataset
+    start = time.perf_counter()
+    df = preprocess_export(read_raw_export(path), branch=path.stem)
+    files = write_prepared_partitions(df, output, path.name)
+    return {'rows': len(df), 'files': files, 'seconds': time.perf_counter() - start}
+
+
+def load_manifest(output):
+    path = output / PREPARED_MANIFEST
+    if not path.exists():
+        return {}
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)['files']
+
+
+def save_manifest(output, files):
+    # Saved after every finished file and renamed into place, so an interrupted run resumes from it
+    path = output / PREPARED_MANIFEST
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'version': 1, 'files': files}, file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_unchanged(path, entry):
+    # Size and mtime decide without reading the file; the digest catches files that were only touched
+    stat = path.stat()
+    if entry is None:
+        return False
+    if (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        return True
+    with open(path, 'rb') as file:
+        if file_digest(file) != entry['digest']:
+            return False
+    entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', type=Path, help="directory with the raw exports (.xlsx, .xls or .csv)")
+    parser.add_argument('output', type=Path, help="directory of the prepared Parquet dataset")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="worker processes (default: all CPUs)")
+    parser.add_argument('--force', action='store_true', help="process every file, even if unchanged")
+    args = parser.parse_args()
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(args.output)
+    sources = sorted(p for p in args.directory.iterdir() if p.suffix.lower() in RAW_EXPORT_SUFFIXES)
+
+    # Data of exports that were removed from the directory is dropped from the dataset
+    for name in set(manifest) - {path.name for path in sources}:
+        for path in prepared_files(args.output, name):
+            path.unlink()
+        del manifest[name]
+        print(f"{name}: removed")
+    save_manifest(args.output, manifest)
+
+    pending = []
+    for path in sources:
+        if not args.force and is_unchanged(path, manifest.get(path.name)):
+            print(f"{path.name}: unchanged")
+        else:
+            pending.append(path)
+    save_manifest(args.output, manifest)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(process_file, path, args.output): path for path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # A failed file is not recorded, so the next run tries it again
+                failed += 1
+                print(f"{path.name}: failed: {e!r}")
+                continue
+            stat = path.stat()
+            with open(path, 'rb') as file:
+                digest = file_digest(file)
+            manifest[path.name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest,
+                                   'rows': result['rows'], 'files': result['files']}
+            save_manifest(args.output, manifest)
+            print(f"{path.name}: {result['rows']:,} rows in {len(result['files'])} partitions "
+                  f"in {result['seconds']:.1f} s")
+
+    print(f"{len(pending) - failed} processed, {len(sources) - len(pending)} unchanged, {failed} failed")
+    sys.exit(1 if failed else 0)
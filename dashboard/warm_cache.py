@@ -0,0 +1,35 @@
+"""
+Pre-warm the persistent dataset cache from a directory of prepared exports,
+so the first upload of each file in the dashboard is served from the cache.
+
+Run from the dashboard directory, e.g.:
+    python warm_cache.py /data/exports --max-gb 10
+"""
+import argparse
+import time
+from pathlib import Path
+
+import functions
+from functions import EXPORT_SUFFIXES, file_digest, read_sales_csv, write_cached_dataset
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', type=Path, help="directory with the CSV exports (plain or compressed)")
+    parser.add_argument('--cache-dir', type=Path, help="overrides DASHBOARD_CACHE_DIR")
+    parser.add_argument('--max-gb', type=float, help="overrides DASHBOARD_CACHE_MAX_GB")
+    args = parser.parse_args()
+
+    if args.cache_dir is not None:
+        functions.CACHE_DIR = args.cache_dir
+    max_bytes = int(args.max_gb * 1024 ** 3) if args.max_gb is not None else None
+
+    for path in sorted(p for p in args.directory.iterdir() if p.suffix.lower() in EXPORT_SUFFIXES):
+        with open(path, 'rb') as file:
+            digest = file_digest(file)
+            if functions.cached_dataset_path(digest).exists():
+                print(f"{path.name}: already cached")
+                continue
+            start = time.perf_counter()
+            df = read_sales_csv(file)
+            write_cached_dataset(digest, df, max_bytes=max_bytes)
+            print(f"{path.name}: cached {len(df):,} rows in {time.perf_counter() - start:.1f} s")
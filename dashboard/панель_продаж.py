@@ -1,56 +1,84 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from functions import optimize_dataframe
-# At the top of your script, before creating the file uploader
-# Increase file upload limit to 1GB (or your desired size)
-import zipfile
-import io
+from pathlib import Path
+from functions import (EXPORT_SUFFIXES, DatasetView, file_digest, load_dataset, dataset_registry, current_session_id,
+                       PREPARED_DATASET_DIR, PREPARED_MANIFEST, prepared_dataset_digest, load_prepared_dataset)
 
-@st.cache_data
 def load_data(uploaded_file):
     if uploaded_file is not None:
-        df = pd.read_csv(uploaded_file, encoding="cp1251", low_memory=False, index_col=0, sep=';', parse_dates=True)
-        df["product"] = df["product"].apply(eval)  # Convert to tuple
-        df["продукция"] = df["product"].apply(lambda x: x[0])
-        df["вид продукции"] = df["product"].apply(lambda x: x[1])
-        return df
-    return None
+        # Hash each upload once per session instead of on every rerun
+        upload_id = getattr(uploaded_file, 'file_id', uploaded_file.name)
+        if st.session_state.get('dataset_upload', (None, None))[0] != upload_id:
+            st.session_state['dataset_upload'] = (upload_id, file_digest(uploaded_file))
+        digest = st.session_state['dataset_upload'][1]
 
+        def loader():
+            progress_bar = st.progress(0.0, text="Загрузка данных...")
+            df = load_dataset(uploaded_file, digest,
+                              progress=lambda fraction: progress_bar.progress(fraction, text="Загрузка данных..."))
+            progress_bar.empty()
+            return df
 
-# Add file uploader to accept both CSV and ZIP files
-uploaded_file = st.file_uploader("Upload your CSV file (or zipped CSV)", type=["csv"])
+        # Sessions that upload the same bytes share one frame held by the process-wide registry
+        df, cube = dataset_registry().acquire(digest, current_session_id(), loader, name=uploaded_file.name)
+        return df, cube, digest
+    return None, None, None
+
+
+def load_prepared(root):
+    # Dataset written by preprocess.py, identified by the hash of its manifest
+    digest = prepared_dataset_digest(root)
+    df, cube = dataset_registry().acquire(digest, current_session_id(), lambda: load_prepared_dataset(root),
+                                          name=Path(root).name)
+    return df, cube, digest
+
+
+# A dataset prepared by preprocess.py can be opened instead of uploading an export
+use_prepared = False
+if PREPARED_DATASET_DIR and (Path(PREPARED_DATASET_DIR) / PREPARED_MANIFEST).exists():
+    use_prepared = st.radio("Источник данных", ["Загрузить файл", "Подготовленный набор"],
+                            horizontal=True) == "Подготовленный набор"
+
+uploaded_file = None
+if not use_prepared:
+    # Add file uploader to accept CSV files and compressed archives (decompressed while parsing)
+    uploaded_file = st.file_uploader("Upload your CSV file (or a .zip/.gz/.xz/.zst archive)",
+                                     type=[suffix.lstrip('.') for suffix in EXPORT_SUFFIXES])
 # Load data when file is uploaded
-if uploaded_file is not None:
-    df = load_data(uploaded_file)
+if use_prepared or uploaded_file is not None:
+    try:
+        df, cube, digest = load_prepared(PREPARED_DATASET_DIR) if use_prepared else load_data(uploaded_file)
+    except MemoryError as e:
+        st.error(f"Файл слишком большой для загрузки: {e}")
+        df = None
+    except ValueError as e:
+        # E.g. malformed product values with DASHBOARD_PRODUCT_STRICT=1
+        st.error(f"Не удалось загрузить данные: {e}")
+        df = None
 
     # Only proceed with the rest of the code if df is not None
     if df is not None:
         st.success("Data loaded successfully!")
 
+        # The pages work on a filtered view of the shared df: filters only build row masks
+        # and the frame itself is never modified or copied into the session
+        branch_view = DatasetView(df, digest=digest, cube=cube)
+
         ################## branch selection
         if 'Branch' in df.columns:
-            all_branches = ['Все компании'] + df['Branch'].unique().tolist()
+            all_branches = ['Все компании'] + branch_view.unique('Branch')
             selected_branches = st.multiselect("Выберите компанию", all_branches, default='Все компании')
             if 'Все компании' not in selected_branches:
-                branch_df = df[df['Branch'].isin(selected_branches)]
+                branch_view = branch_view.isin('Branch', selected_branches)
                 branch_title = f" - {', '.join(selected_branches)} Branch"
             else:
-                branch_df = df
                 branch_title = " - Все компании"
         else:
-            branch_df = df
             branch_title = ""
 
-        ############## Create date components from index
-        branch_df['Год'] = branch_df.index.year.astype(str)
-        branch_df['Месяц'] = branch_df.index.month
-        branch_df['Четверть'] = branch_df.index.quarter
-        branch_df['ГодМесяц'] = branch_df.index.strftime('%Y-%m')
-        branch_df['ГодЧетверть'] = branch_df['Год'].astype(str) + '-Q' + branch_df['Четверть'].astype(str)
-
-        # Store both the filtered dataframe and the title in session state
-        st.session_state['branch_df'] = branch_df
+        # Store both the filtered view and the title in session state
+        st.session_state['branch_view'] = branch_view
         st.session_state['branch_title'] = branch_title
         # Optional: Display a success message
         st.success(f"Данные выбранной компании сохранены в сессии")